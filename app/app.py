@@ -1,10 +1,15 @@
 import streamlit as st
 import sys
 import os
+import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'scripts'))
 
-from rag_pipeline import retrieve, build_prompt, generate_answer
+from rag_pipeline import retrieve, build_prompt, generate_answer_stream, get_semantic_cache, score_label
+from answer_cache import get_answer_cache
+from resources import get_resources
+import tracing
+from tracing import span, trace
 
 # Page configuration
 st.set_page_config(
@@ -13,6 +18,25 @@ st.set_page_config(
     layout="centered"
 )
 
+
+# Load the model, index and chunks once per server process and share
+# them across every session and rerun. The first visitor sees the
+# spinner; everyone after that gets the already-warm pipeline.
+@st.cache_resource(show_spinner="Loading research database...")
+def load_resources():
+    return get_resources().warm_up()
+
+
+# Near-duplicates of questions we've already answered (including the
+# whole generated dataset) are answered straight from this cache
+@st.cache_resource(show_spinner="Loading answered questions...")
+def load_semantic_cache():
+    return get_semantic_cache()
+
+
+load_resources()
+semantic_cache = load_semantic_cache()
+
 # Header
 st.title("🔬 Peptide Research Assistant")
 st.caption("Educational tool powered by published research. Not medical advice.")
@@ -29,23 +53,81 @@ question = st.text_input(
     placeholder="e.g. What are the side effects of BPC-157?"
 )
 
+SOURCE_FILTERS = {
+    "All research": None,
+    "Published studies (PubMed)": {"source": "pubmed"},
+    "Clinical trials": {"source": "clinicaltrials"}
+}
+search_in = st.radio("Search in:", list(SOURCE_FILTERS), horizontal=True)
+filters = SOURCE_FILTERS[search_in]
+
+# Only offered when tracing is switched on for this server
+show_debug = tracing.ENABLED and st.sidebar.checkbox("Show debug timings")
+
 if st.button("Search Research", type="primary"):
     if not question.strip():
         st.error("Please enter a question.")
     else:
-        with st.spinner("Searching research database..."):
-            retrieved = retrieve(question, k=5)
+        # Every stage of answering this question is timed into one
+        # trace when tracing is on (RAG_TRACING=1, see tracing.py)
+        with trace("question", source_filter=search_in) as question_trace:
+            # Cached answers were written from unfiltered results
+            with span("semantic_cache_lookup") as lookup:
+                hit = semantic_cache.lookup(question) if filters is None else None
+                lookup.set(hit=hit is not None)
+
+            if hit is not None:
+                retrieved = hit["sources"]
+                st.subheader("Answer")
+                st.markdown(hit["answer"])
+                st.caption(f"Answered from a similar question: \"{hit['question']}\" (similarity {hit['similarity']:.2f})")
+                print(f"Semantic cache hit ({hit['similarity']:.2f}): {hit['question']}")
+            else:
+                with st.spinner("Searching research database..."):
+                    retrieved = retrieve(question, k=5, filters=filters)
+
+                prompt = build_prompt(question, retrieved)
+
+                # Display answer, streaming it in as the model writes it
+                st.subheader("Answer")
+                timings = {}
 
-        with st.spinner("Generating answer..."):
-            prompt = build_prompt(question, retrieved)
-            answer = generate_answer(prompt)
+                def timed_stream():
+                    start = time.perf_counter()
+                    # Repeat questions are answered from the local answer cache
+                    for token in generate_answer_stream(prompt, cache=get_answer_cache()):
+                        # Time to first token is what users actually feel
+                        timings.setdefault("first_token", time.perf_counter() - start)
+                        yield token
+                    timings["total"] = time.perf_counter() - start
 
-        # Display answer
-        st.subheader("Answer")
-        st.markdown(answer)
+                answer = st.write_stream(timed_stream())
+
+                if "first_token" in timings:
+                    st.caption(
+                        f"First token in {timings['first_token']:.2f}s · "
+                        f"full answer in {timings['total']:.2f}s"
+                    )
+                    print(f"Generation: first token {timings['first_token']:.2f}s, "
+                          f"total {timings['total']:.2f}s, {len(answer)} chars")
+
+                # Only cache answers that finished streaming
+                if "total" in timings and filters is None:
+                    semantic_cache.add(question, answer, retrieved)
 
         # Display sources
         st.subheader("Sources")
         for i, chunk in enumerate(retrieved):
-            with st.expander(f"Source {i+1} — {chunk['source'].upper()} (score: {chunk['score']})"):
-                st.write(chunk['text'])
\ No newline at end of file
+            with st.expander(f"Source {i+1} — {chunk['source'].upper()} ({score_label(chunk)})"):
+                st.write(chunk['text'])
+
+        # Per-stage timings for this question, for debugging slowness
+        if show_debug and question_trace.recording:
+            details = question_trace.to_dict()
+            with st.expander(f"Debug: {details['duration_ms']:.0f} ms total", expanded=True):
+                st.table([
+                    {"stage": "  " * s["depth"] + s["name"], "start (ms)": s["offset_ms"], "ms": s["duration_ms"]}
+                    for s in details["spans"]
+                ])
+                st.json(details["spans"], expanded=False)
+                st.code(tracing.prometheus_text(), language="text")
\ No newline at end of file
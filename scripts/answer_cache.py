@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+ANSWER_CACHE_PATH = "data/answer_cache.sqlite"
+
+# Generated answers are a few KB each, so 50 MB holds tens of thousands
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+# Answers older than this are regenerated, so improvements to the
+# knowledge base or prompt eventually show up even for cached questions
+DEFAULT_TTL = 30 * 86400
+
+
+class AnswerCache:
+    """
+    Disk-backed cache of generated answers, keyed on the generation
+    model, a hash of the full prompt and the generation parameters.
+
+    The same prompt always comes from the same question and retrieved
+    chunks, so a hit skips the remote LLM call entirely. Entries
+    expire after `ttl` seconds, and once the cache grows past
+    `max_bytes` the least recently used answers are evicted.
+    """
+
+    def __init__(self, path=ANSWER_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # Shared between Streamlit sessions and worker threads
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key        TEXT PRIMARY KEY,
+                model      TEXT,
+                answer     TEXT,
+                size       INTEGER,
+                created_at REAL,
+                last_used  REAL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+        self.db.commit()
+
+    @staticmethod
+    def cache_key(model, prompt, params):
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        raw = json.dumps([model, prompt_hash, sorted((params or {}).items())])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, model, prompt, params=None):
+        """Returns the cached answer, or None on a miss."""
+        key = self.cache_key(model, prompt, params)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT answer, created_at FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] < self.ttl:
+                self.db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+                self.db.commit()
+                self.hits += 1
+                return row[0]
+            if row is not None:
+                self.db.execute("DELETE FROM answers WHERE key = ?", (key,))
+                self.db.commit()
+            self.misses += 1
+            return None
+
+    def put(self, model, prompt, params, answer):
+        key = self.cache_key(model, prompt, params)
+        now = time.time()
+        size = len(answer.encode("utf-8"))
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, answer, size, now, now)
+            )
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        """Drops expired answers, then least recently used ones until we're under max_bytes."""
+        self.db.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl,))
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        to_free = total - self.max_bytes
+        doomed = []
+        for key, size in self.db.execute("SELECT key, size FROM answers ORDER BY last_used"):
+            doomed.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        self.db.executemany("DELETE FROM answers WHERE key = ?", doomed)
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self.lock:
+            entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """
+    Returns the shared answer cache, creating it on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnswerCache()
+    return _cache
@@ -0,0 +1,398 @@
+import argparse
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+
+from build_index import (DEFAULT_TRAIN_SIZE, MODEL_NAME, STORAGE_TYPES, embed_chunks, make_index,
+                         train_index)
+from encoders import ENCODER_BACKENDS, make_encoder
+from generate_dataset import QUESTIONS
+from index_io import apply_search_params
+from rag_pipeline import RETRIEVAL_MODES, get_resources, retrieve_many
+
+# The labelled query set: every question in generate_dataset.QUESTIONS
+# with the documents (PMIDs / NCT IDs) a good answer should draw on.
+# It's seeded from exact search the first time, and meant to be
+# reviewed and corrected by hand after that — edits are kept. Set an
+# entry's "labelled_by" to "hand" once it's been checked: seeded labels
+# are just the exact-search baseline again, so only hand-checked ones
+# count towards the label metrics.
+QUERY_SET_PATH = "data/benchmark_queries.json"
+
+# No hand-checked labels ship with the repo. Until at least this many
+# questions have been checked, the label recall/MRR columns are left
+# out of the report altogether (and label_metrics is false in the
+# results), rather than printed from a handful of questions or none.
+MIN_HAND_LABELLED = 10
+
+# Latest results, plus one line per run so changes can be compared
+RESULTS_PATH = "data/benchmark_results.json"
+HISTORY_PATH = "data/benchmark_history.jsonl"
+
+DEFAULT_INDEXES = ["flat", "ivf_flat", "ivf_pq", "hnsw"]
+DEFAULT_STORAGE = ["float32", "fp16", "sq8"]
+
+# How many documents the seed labels expect per question
+LABEL_DOCUMENTS = 5
+
+
+def document_key(chunk):
+    """
+    The document a chunk came from. Labels are kept per document rather
+    than per chunk id, so they still hold after the corpus is rechunked
+    or the index rebuilt.
+    """
+    if chunk.get("pmid"):
+        return f"PMID {chunk['pmid']}"
+    if chunk.get("nct_id"):
+        return chunk["nct_id"]
+    return chunk.get("title") or chunk.get("query")
+
+
+def seed_query_set(chunks, embeddings, query_vectors, path=QUERY_SET_PATH):
+    """
+    Labels each question with the documents of its nearest chunks
+    under exact search, writes the query set and returns it.
+    """
+    _, neighbours = faiss.knn(query_vectors, embeddings, LABEL_DOCUMENTS * 4)
+    query_set = []
+    for question, row in zip(QUESTIONS, neighbours):
+        documents = []
+        for idx in row:
+            key = document_key(chunks[int(idx)])
+            if key and key not in documents:
+                documents.append(key)
+        query_set.append({
+            "question": question,
+            "expected_documents": documents[:LABEL_DOCUMENTS],
+            "expected_chunks": [int(idx) for idx in row[:LABEL_DOCUMENTS]],
+            "labelled_by": "exact_search"
+        })
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(query_set, f, indent=2)
+    os.replace(tmp_path, path)
+    print(f"Wrote seed labels for {len(query_set)} questions to {path} — review them by hand")
+    return query_set
+
+
+def load_query_set(path=QUERY_SET_PATH):
+    """
+    Returns the labelled query set, or None if there isn't one yet.
+    Questions added to QUESTIONS since it was written are picked up
+    by re-running with --relabel.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def recall_at_k(found, truth, k):
+    """Fraction of the true top k that shows up in the found top k."""
+    truth = list(truth)[:k]
+    if not truth:
+        return 1.0
+    return len(set(list(found)[:k]).intersection(truth)) / len(truth)
+
+
+def reciprocal_rank(found, is_relevant):
+    for rank, item in enumerate(found, start=1):
+        if is_relevant(item):
+            return 1.0 / rank
+    return 0.0
+
+
+def score_results(found_ids, exact_ids, query_set, chunks, k, use_labels=True):
+    """
+    Quality of one configuration's results (one list of chunk ids per
+    question):
+
+    - recall@k and MRR against exact flat search, where MRR is the
+      mean reciprocal rank of the true nearest chunk
+    - label recall@k and MRR against the labelled documents, over the
+      hand-checked questions only (left out if there are none, or if
+      use_labels is False)
+    """
+    recalls, ranks, label_recalls, label_ranks = [], [], [], []
+    for found, exact, labels in zip(found_ids, exact_ids, query_set):
+        found = [int(i) for i in found if i >= 0]
+        recalls.append(recall_at_k(found, exact, k))
+        ranks.append(reciprocal_rank(found, lambda idx: idx == int(exact[0])))
+
+        if not use_labels or labels.get("labelled_by") != "hand":
+            continue
+        expected = set(labels["expected_documents"])
+        documents = [document_key(chunks[idx]) for idx in found[:k]]
+        label_recalls.append(len(expected.intersection(documents)) / len(expected) if expected else 1.0)
+        label_ranks.append(reciprocal_rank(documents, lambda key: key in expected))
+
+    scores = {
+        f"recall_at_{k}": round(float(np.mean(recalls)), 4),
+        "mrr": round(float(np.mean(ranks)), 4)
+    }
+    if label_recalls:
+        scores[f"label_recall_at_{k}"] = round(float(np.mean(label_recalls)), 4)
+        scores["label_mrr"] = round(float(np.mean(label_ranks)), 4)
+    return scores
+
+
+def latency_summary(seconds):
+    """p50/p95/p99 of per-query timings, in milliseconds."""
+    ms = np.array(seconds) * 1000
+    return {f"p{p}_ms": round(float(np.percentile(ms, p)), 3) for p in (50, 95, 99)}
+
+
+def time_per_query(run, items, repeat):
+    """Times run(item) for every item, repeat times over."""
+    timings = []
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            run(item)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def benchmark_index(spec, storage, embeddings, query_vectors, k, repeat, train_size):
+    """
+    Builds one index configuration over the chunk embeddings and
+    measures its search latency, throughput and size. Returns the
+    result together with the ids it found for each query.
+    """
+    start = time.perf_counter()
+    index, factory, search_params, storage = make_index(
+        spec, embeddings.shape[1], min(len(embeddings), train_size), storage=storage
+    )
+    train_index(index, embeddings, train_size=train_size)
+    index.add(embeddings)
+    apply_search_params(index, search_params)
+    build_seconds = time.perf_counter() - start
+
+    # One query at a time, the way the app searches
+    index.search(query_vectors[:1], k)
+    timings = time_per_query(lambda q: index.search(q[None], k), query_vectors, repeat)
+
+    # All questions in one batch, the way generate_dataset searches
+    batch_seconds = min(
+        time_per_query(lambda queries: index.search(queries, k), [query_vectors], repeat)
+    )
+    _, found = index.search(query_vectors, k)
+
+    result = {
+        "spec": spec,
+        "storage": storage,
+        "factory": factory,
+        "search_params": search_params,
+        "build_seconds": round(build_seconds, 2),
+        "index_bytes": len(faiss.serialize_index(index)),
+        **latency_summary(timings),
+        "batch_qps": round(len(query_vectors) / max(batch_seconds, 1e-9), 1)
+    }
+    return result, found
+
+
+def benchmark_encoder(backend, questions, reference_vectors, embeddings, k, repeat):
+    """
+    Loads one query encoder backend and measures its load time,
+    per-query encode latency, throughput and agreement with the torch
+    model. Returns the result together with the ids exact search
+    finds for its query embeddings.
+    """
+    start = time.perf_counter()
+    encoder = make_encoder(MODEL_NAME, backend)
+    load_seconds = time.perf_counter() - start
+
+    encoder.encode(questions[:1])
+    timings = time_per_query(lambda q: encoder.encode([q]), questions, repeat)
+    batch_seconds = min(time_per_query(encoder.encode, [questions], repeat))
+
+    vectors = np.ascontiguousarray(encoder.encode(questions), dtype="float32")
+    a = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    b = reference_vectors / np.linalg.norm(reference_vectors, axis=1, keepdims=True)
+    _, found = faiss.knn(vectors, embeddings, k)
+
+    result = {
+        "backend": encoder.backend,
+        "load_seconds": round(load_seconds, 2),
+        **latency_summary(timings),
+        "batch_qps": round(len(questions) / max(batch_seconds, 1e-9), 1),
+        "min_cosine_vs_torch": round(float((a * b).sum(axis=1).min()), 6)
+    }
+    return result, found
+
+
+def benchmark_pipeline(mode, questions, k, repeat):
+    """
+    Measures retrieve_many end to end — encoding, the index on disk,
+    BM25 and fusion — as the app runs it. The query caches are
+    cleared before every call so each one pays the full cost.
+    """
+    resources = get_resources()
+
+    def run(question):
+        resources.query_embedding_cache.clear()
+        resources.retrieval_cache.clear()
+        return retrieve_many([question], k=k, mode=mode)[0]
+
+    run(questions[0])
+    timings = time_per_query(run, questions, repeat)
+    found = [[r["id"] for r in run(question)] for question in questions]
+
+    result = {
+        "mode": mode,
+        "index": resources.index_meta.get("factory"),
+        "encoder": resources.model.backend,
+        **latency_summary(timings)
+    }
+    return result, found
+
+
+def print_table(title, rows, label, show_labels=True):
+    print(f"\n{title}")
+    labels_header = f" {'labels':>7}" if show_labels else ""
+    print(f"  {'config':<28} {'recall':>7} {'mrr':>6}{labels_header} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'qps':>9} {'size MB':>8}")
+    for row in rows:
+        if "error" in row:
+            print(f"  {label(row):<28} {row['error']}")
+            continue
+        recall = next(v for key, v in row.items() if key.startswith("recall_at_"))
+        label_recall = next((f"{v:.3f}" for key, v in row.items() if key.startswith("label_recall_at_")), "-")
+        label_column = f" {label_recall:>7}" if show_labels else ""
+        size = f"{row['index_bytes'] / 1e6:.1f}" if "index_bytes" in row else "-"
+        print(f"  {label(row):<28} {recall:>7.3f} {row['mrr']:>6.3f}{label_column} "
+              f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} "
+              f"{row.get('batch_qps', '-'):>9} {size:>8}")
+
+
+def run_benchmark(indexes=DEFAULT_INDEXES, storage_types=DEFAULT_STORAGE, encoders=("torch",),
+                  modes=RETRIEVAL_MODES, k=10, repeat=5, train_size=DEFAULT_TRAIN_SIZE,
+                  query_set_path=QUERY_SET_PATH, relabel=False, output_path=RESULTS_PATH):
+    """
+    Runs the labelled questions through every index, encoder and
+    retrieval mode configuration and writes the results as JSON.
+
+    The baseline for recall and MRR is exact flat search over the
+    same chunk embeddings with the torch encoder. Index configurations
+    are all searched with the torch query embeddings, and encoder
+    backends all with exact search, so each comparison changes one thing.
+    """
+    resources = get_resources()
+    chunks = resources.chunks
+    print(f"Loading embeddings for {len(chunks)} chunks...")
+    embeddings = np.ascontiguousarray(embed_chunks([chunk["text"] for chunk in chunks]), dtype="float32")
+
+    query_set = None if relabel else load_query_set(query_set_path)
+    questions = [entry["question"] for entry in query_set] if query_set else list(QUESTIONS)
+    reference_vectors = np.ascontiguousarray(make_encoder(MODEL_NAME, "torch").encode(questions), dtype="float32")
+    if query_set is None:
+        query_set = seed_query_set(chunks, embeddings, reference_vectors, query_set_path)
+    _, exact_ids = faiss.knn(reference_vectors, embeddings, k)
+    hand_labelled = sum(entry.get("labelled_by") == "hand" for entry in query_set)
+    use_labels = hand_labelled >= MIN_HAND_LABELLED
+    labels_note = (f"Label metrics left out: {hand_labelled} of {len(questions)} questions in "
+                   f"{query_set_path} are hand-checked, {MIN_HAND_LABELLED} needed")
+    print(f"Benchmarking {len(questions)} questions, k={k}, {repeat} timed passes each")
+    if not use_labels:
+        print(f"  {labels_note}")
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": MODEL_NAME,
+        "chunks": len(chunks),
+        "queries": len(questions),
+        "hand_labelled_queries": hand_labelled,
+        "label_metrics": use_labels,
+        "k": k,
+        "repeat": repeat,
+        "threads": faiss.omp_get_max_threads(),
+        "baseline": "exact flat search, torch encoder",
+        "float32_bytes": int(embeddings.nbytes),
+        "indexes": [],
+        "encoders": [],
+        "pipeline": []
+    }
+
+    for spec in indexes:
+        for storage in storage_types:
+            try:
+                result, found = benchmark_index(spec, storage, embeddings, reference_vectors, k, repeat, train_size)
+            except ValueError as e:
+                # Combinations like hnsw with pq storage don't exist
+                print(f"  Skipping {spec} with {storage} storage: {e}")
+                continue
+            # ivf_pq with float32 or pq storage is the same index, so only report it once
+            if any(r["factory"] == result["factory"] for r in results["indexes"]):
+                continue
+            result.update(score_results(found, exact_ids, query_set, chunks, k, use_labels))
+            results["indexes"].append(result)
+            print(f"  {result['factory']}: done")
+
+    for backend in encoders:
+        try:
+            result, found = benchmark_encoder(backend, questions, reference_vectors, embeddings, k, repeat)
+        except (ImportError, OSError, ValueError) as e:
+            # e.g. onnx before `encoders.py --export`, or onnxruntime not installed
+            results["encoders"].append({"backend": backend, "error": f"{type(e).__name__}: {e}"})
+            continue
+        result.update(score_results(found, exact_ids, query_set, chunks, k, use_labels))
+        results["encoders"].append(result)
+
+    for mode in modes:
+        result, found = benchmark_pipeline(mode, questions, k, repeat)
+        result.update(score_results(found, exact_ids, query_set, chunks, k, use_labels))
+        results["pipeline"].append(result)
+
+    print_table("Index configurations (torch query embeddings)", results["indexes"],
+                lambda r: r["factory"], use_labels)
+    print_table("Encoder backends (exact search)", results["encoders"], lambda r: r["backend"], use_labels)
+    print_table("Pipeline as served (retrieve_many, caches cleared)", results["pipeline"],
+                lambda r: f"{r['mode']} ({r['index']}, {r['encoder']})", use_labels)
+    if not use_labels:
+        # Say so under the tables too, so a missing column isn't mistaken for a result
+        print(f"\n{labels_note} (mark checked entries \"labelled_by\": \"hand\")")
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp_path, output_path)
+    with open(HISTORY_PATH, "a") as f:
+        f.write(json.dumps(results) + "\n")
+    print(f"\nSaved results to {output_path} (and appended them to {HISTORY_PATH})")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark retrieval quality and latency")
+    parser.add_argument("--indexes", nargs="+", default=DEFAULT_INDEXES,
+                        help="index specs to compare, as in build_index.py --index")
+    parser.add_argument("--storage", nargs="+", default=DEFAULT_STORAGE, choices=list(STORAGE_TYPES),
+                        help="vector storage types to try with each index")
+    parser.add_argument("--encoders", nargs="+", default=["torch"], choices=ENCODER_BACKENDS,
+                        help="query encoder backends to compare")
+    parser.add_argument("--modes", nargs="*", default=list(RETRIEVAL_MODES), choices=RETRIEVAL_MODES,
+                        help="retrieval modes to run through the full pipeline (none to skip)")
+    parser.add_argument("--k", type=int, default=10, help="results per question")
+    parser.add_argument("--repeat", type=int, default=5, help="timed passes over the questions")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="FAISS threads (default: all cores)")
+    parser.add_argument("--train-size", type=int, default=DEFAULT_TRAIN_SIZE,
+                        help="number of vectors to train IVF/PQ indexes on")
+    parser.add_argument("--queries", default=QUERY_SET_PATH, help="labelled query set")
+    parser.add_argument("--relabel", action="store_true",
+                        help="re-seed the query set from exact search, overwriting hand edits")
+    parser.add_argument("--output", default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+    run_benchmark(indexes=args.indexes, storage_types=args.storage, encoders=args.encoders,
+                  modes=args.modes, k=args.k, repeat=args.repeat, train_size=args.train_size,
+                  query_set_path=args.queries, relabel=args.relabel, output_path=args.output)
@@ -0,0 +1,167 @@
+import json
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+BM25_INDEX_PATH = "data/bm25_index.npz"
+
+# Standard BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# A token is a run of letters/digits, optionally joined by hyphens or
+# dots, so "BPC-157", "GHK-Cu", "AOD-9604" and "NCT01234567" stay whole
+# instead of being split into pieces that match everything
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-.][a-z0-9]+)*")
+
+# Words too common to say anything about relevance
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for",
+    "from", "has", "have", "how", "in", "is", "it", "its", "of", "on", "or",
+    "that", "the", "this", "to", "was", "were", "what", "when", "which", "with"
+}
+
+
+def tokenize(text):
+    """
+    Lowercases and splits text into search terms. Compound names are
+    kept whole, and their parts are added too, so a question about
+    "BPC 157" still matches chunks that say "BPC-157".
+    """
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if "-" in token or "." in token:
+            tokens.extend(part for part in re.split(r"[-.]", token) if part not in STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    """
+    A BM25 inverted index over the chunks, stored as flat arrays.
+
+    Postings for term t are doc_ids[offsets[t]:offsets[t+1]], and the
+    matching entries in `weights` are the full BM25 contribution of t
+    to each of those chunks, precomputed at build time. Scoring a
+    query is then just summing a few postings slices — no per-query
+    tf/idf maths and no scan over the whole corpus.
+    """
+
+    def __init__(self, terms, offsets, doc_ids, weights, n_docs):
+        self.terms = terms
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, texts, k1=K1, b=B):
+        """
+        Tokenizes every text and builds the postings lists. Row i in
+        the BM25 index is row i in the FAISS index.
+        """
+        start = time.time()
+        vocabulary = {}
+        term_ids, doc_ids, term_freqs = [], [], []
+        doc_lengths = np.zeros(len(texts), dtype="float32")
+
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_ids.append(doc_id)
+                term_freqs.append(tf)
+
+        term_ids = np.array(term_ids, dtype="int64")
+        doc_ids = np.array(doc_ids, dtype="int32")
+        term_freqs = np.array(term_freqs, dtype="float32")
+
+        # Group postings by term (stable, so each list stays sorted by doc id)
+        order = np.argsort(term_ids, kind="stable")
+        term_ids, doc_ids, term_freqs = term_ids[order], doc_ids[order], term_freqs[order]
+        doc_freqs = np.bincount(term_ids, minlength=len(vocabulary))
+        offsets = np.zeros(len(vocabulary) + 1, dtype="int64")
+        np.cumsum(doc_freqs, out=offsets[1:])
+
+        n_docs = len(texts)
+        avg_length = float(doc_lengths.mean()) if n_docs else 0.0
+        idf = np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype("float32")
+        norm = k1 * (1 - b + b * doc_lengths[doc_ids] / max(avg_length, 1e-9))
+        weights = idf[term_ids] * term_freqs * (k1 + 1) / (term_freqs + norm)
+
+        terms = sorted(vocabulary, key=vocabulary.get)
+        print(f"BM25 index built: {len(terms)} terms, {len(doc_ids)} postings "
+              f"in {time.time() - start:.1f}s")
+        return cls(terms, offsets, doc_ids, weights.astype("float32"), n_docs)
+
+    def save(self, path=BM25_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Write to a temp file and swap it in, so a running app never
+        # loads a half-written index
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            terms=np.array(json.dumps(self.terms)),
+            offsets=self.offsets,
+            doc_ids=self.doc_ids,
+            weights=self.weights,
+            n_docs=np.array(self.n_docs)
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=BM25_INDEX_PATH):
+        with np.load(path) as data:
+            return cls(
+                json.loads(str(data["terms"])),
+                data["offsets"],
+                data["doc_ids"],
+                data["weights"],
+                int(data["n_docs"])
+            )
+
+    def search(self, query, k=5, allowed=None):
+        """
+        Returns (scores, doc_ids) for the k best-matching chunks,
+        best first. Only the postings of the query's terms are read.
+        allowed, a sorted array of chunk ids, restricts the results
+        to those chunks.
+        """
+        slices = []
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is not None:
+                slices.append(slice(self.offsets[term_id], self.offsets[term_id + 1]))
+        if not slices:
+            return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+
+        doc_ids = np.concatenate([self.doc_ids[s] for s in slices])
+        weights = np.concatenate([self.weights[s] for s in slices])
+        matched, inverse = np.unique(doc_ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        if allowed is not None:
+            keep = np.isin(matched, allowed, assume_unique=True)
+            matched, scores = matched[keep], scores[keep]
+
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return scores[top].astype("float32"), matched[top].astype("int64")
+
+
+def load_bm25_index(path=BM25_INDEX_PATH):
+    """
+    Returns the BM25 index, or None if build_index hasn't written one yet.
+    """
+    if not os.path.exists(path):
+        return None
+    return BM25Index.load(path)
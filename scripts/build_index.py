@@ -1,64 +1,407 @@
+import argparse
 import json
+import math
 import os
+import time
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+from bm25_index import BM25_INDEX_PATH, BM25Index
+from bulk_embed import bulk_embed
+from chunk_store import CHUNK_STORE_PATH, CHUNKS_JSON_PATH, write_chunk_store
+from embedding_cache import EmbeddingCache, text_hash
+from index_io import (INDEX_META_PATH, INDEX_PATH, apply_search_params, enable_reconstruct,
+                      partition_path, publish, save_index, save_index_meta, staged_path)
+from metadata_index import METADATA_INDEX_PATH, MetadataIndex
 
 # This is the embedding model we're using.
 # It converts text into a 384-dimensional vector.
 # It's small, fast, and works great for semantic search.
-model = SentenceTransformer("all-MiniLM-L6-v2")
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+# Where the bulk embedder writes vectors as they're encoded
+BULK_EMBEDDINGS_PATH = "data/embeddings.f32"
+
+# The model is only loaded if there's something new to embed,
+# so a rebuild where every chunk is cached skips it entirely
+_model = None
+
+
+def get_model():
+    global _model
+    if _model is None:
+        # Imported here so the FAISS helpers can be used without
+        # pulling in torch and sentence-transformers
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+def encode_texts(texts, workers=None):
+    """
+    Encodes texts in this process, or with the multi-process,
+    length-bucketed bulk embedder when workers is set.
+    """
+    if workers:
+        return bulk_embed(texts, MODEL_NAME, BULK_EMBEDDINGS_PATH, workers=workers)
+    embeddings = get_model().encode(texts, show_progress_bar=True, batch_size=64)
+    return np.array(embeddings).astype("float32")
+
+
+def embed_chunks(texts, use_cache=True, workers=None):
+    """
+    Returns a float32 embedding for every text. With the cache on,
+    only texts we've never embedded before are sent through the
+    model; everything else is read back from the embedding cache.
+    """
+    if not use_cache:
+        return encode_texts(texts, workers=workers)
+
+    cache = EmbeddingCache(MODEL_NAME)
+    hashes = [text_hash(text) for text in texts]
+    missing = cache.missing(hashes)
+    print(f"Embedding cache: {len(hashes) - len(missing)} hits, {len(missing)} new chunks to embed")
+
+    if missing:
+        # Duplicate texts share a hash, so each one is only encoded once
+        first_text = {}
+        for h, text in zip(hashes, texts):
+            first_text.setdefault(h, text)
+
+        start = time.time()
+        new_vectors = encode_texts([first_text[h] for h in missing], workers=workers)
+        cache.add(missing, new_vectors)
+        print(f"  Encoded {len(missing)} chunks in {time.time() - start:.1f}s")
+        if workers:
+            # The cache has its own copy now
+            del new_vectors
+            os.remove(BULK_EMBEDDINGS_PATH)
+
+    return cache.get(hashes)
+
 
-def build_index(chunks_path="data/chunks.json"):
+# The index types build_index knows about. Each one is a FAISS
+# index_factory string; {placeholders} are filled from the spec
+# options (or sensible defaults based on corpus size).
+#   flat      exact search, scans every vector (the old IndexFlatL2)
+#   ivf_flat  clusters vectors into nlist lists, searches nprobe of them
+#   ivf_pq    IVF plus product quantization, vectors stored as m-byte codes
+#   hnsw      graph index, no training, tuned with efSearch
+INDEX_TYPES = {
+    "flat": "{codec}",
+    "ivf_flat": "IVF{nlist},{codec}",
+    "ivf_pq": "IVF{nlist},{codec}",
+    "hnsw": "HNSW{m}{hnsw_codec}",
+}
+
+# How the vectors themselves are stored, and bytes per 384-dim vector:
+#   float32  full precision (1536 bytes)
+#   fp16     half precision (768 bytes), practically no recall loss
+#   sq8      8-bit scalar quantization (384 bytes), a small recall loss
+#   pq       product quantization codes (m bytes, 48 by default), the
+#            smallest but the least exact; not available with hnsw
+STORAGE_TYPES = {
+    "float32": "Flat",
+    "fp16": "SQfp16",
+    "sq8": "SQ8",
+    "pq": "PQ{m}x{nbits}",
+}
+
+# Vectors used to train IVF centroids / PQ codebooks. Training on a
+# sample is much faster than on everything and barely hurts recall.
+DEFAULT_TRAIN_SIZE = 100_000
+
+
+def parse_index_spec(spec):
+    """
+    Parses an index spec like "ivf_pq:nlist=1024,m=48,nprobe=16"
+    into ("ivf_pq", {"nlist": 1024, "m": 48, "nprobe": 16}).
+    """
+    name, _, options = spec.partition(":")
+    if name not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{name}', expected one of {', '.join(INDEX_TYPES)}")
+
+    opts = {}
+    for option in filter(None, options.split(",")):
+        key, _, value = option.partition("=")
+        opts[key.strip()] = int(value)
+    return name, opts
+
+
+def make_index(spec, dimension, n, storage="float32"):
+    """
+    Creates an (untrained) FAISS index from a spec and returns it
+    together with its factory string, default search parameters and
+    vector storage type (see STORAGE_TYPES).
+    n is the number of vectors the index will be trained on.
+    """
+    name, opts = parse_index_spec(spec)
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage '{storage}', expected one of {', '.join(STORAGE_TYPES)}")
+    search_params = {}
+
+    # ivf_pq is IVF with PQ storage by definition
+    if name == "ivf_pq":
+        if storage not in ("float32", "pq"):
+            raise ValueError(f"ivf_pq already stores PQ codes, it can't use {storage} storage")
+        storage = "pq"
+    if name == "hnsw" and storage == "pq":
+        raise ValueError("hnsw supports float32, fp16 or sq8 storage, not pq")
+
+    if name in ("ivf_flat", "ivf_pq"):
+        # Rule of thumb: ~4*sqrt(n) lists, but FAISS wants at least
+        # 39 training points per list. An explicit nlist is capped the
+        # same way, so a spec sized for the whole corpus still builds
+        # on a small partition.
+        max_nlist = max(1, n // 39)
+        opts.setdefault("nlist", min(int(4 * math.sqrt(n)), max_nlist))
+        if opts["nlist"] > max_nlist:
+            print(f"  nlist={opts['nlist']} needs {opts['nlist'] * 39} training vectors, "
+                  f"only {n} available — using nlist={max_nlist}")
+            opts["nlist"] = max_nlist
+        search_params["nprobe"] = min(opts["nlist"], opts.pop("nprobe", max(8, opts["nlist"] // 16)))
+
+    if storage == "pq":
+        # 8 dimensions per sub-quantizer by default; m has to divide the dimension
+        opts.setdefault("m", dimension // 8)
+        if dimension % opts["m"]:
+            raise ValueError(f"PQ m={opts['m']} must divide the embedding dimension {dimension}")
+        # Each codebook needs at least 2^nbits training points
+        max_nbits = max(1, int(math.log2(max(n, 2))))
+        opts["nbits"] = min(opts.get("nbits", 8), max_nbits)
+
+    if name == "hnsw":
+        opts.setdefault("m", 32)
+        search_params["efSearch"] = opts.pop("efSearch", 64)
+        ef_construction = opts.pop("efConstruction", 200)
+
+    codec = STORAGE_TYPES[storage].format(**opts)
+    hnsw_codec = "" if storage == "float32" else f"_{codec}"
+    factory = INDEX_TYPES[name].format(codec=codec, hnsw_codec=hnsw_codec, **opts)
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_L2)
+    if name == "hnsw":
+        index.hnsw.efConstruction = ef_construction
+
+    return index, factory, search_params, storage
+
+
+def measure_recall(index, embeddings, k=10, n_queries=1000, seed=0):
+    """
+    Recall@k of the index against exact flat search, using a sample
+    of the chunk vectors as queries. Each query's own vector is left
+    out of both result lists, since finding it is no test at all.
+    """
+    rng = np.random.default_rng(seed)
+    query_ids = rng.choice(len(embeddings), min(n_queries, len(embeddings)), replace=False)
+    queries = np.ascontiguousarray(embeddings[query_ids])
+
+    _, exact = faiss.knn(queries, embeddings, k + 1)
+    _, found = index.search(queries, k + 1)
+
+    hits = 0
+    total = 0
+    for query_id, exact_row, found_row in zip(query_ids, exact, found):
+        truth = [i for i in exact_row if i != query_id][:k]
+        got = {i for i in found_row if i != query_id and i >= 0}
+        hits += len(got.intersection(truth))
+        total += len(truth)
+    return hits / total if total else 1.0
+
+
+def train_index(index, embeddings, train_size=DEFAULT_TRAIN_SIZE, seed=0):
+    """
+    Trains IVF/PQ indexes on a random sample of the vectors.
+    Flat and HNSW indexes don't need training and are left alone.
+    """
+    if index.is_trained:
+        return
+
+    sample = embeddings
+    if len(embeddings) > train_size:
+        rng = np.random.default_rng(seed)
+        sample = embeddings[np.sort(rng.choice(len(embeddings), train_size, replace=False))]
+
+    start = time.time()
+    print(f"Training index on {len(sample)} vectors...")
+    index.train(np.ascontiguousarray(sample))
+    print(f"  Trained in {time.time() - start:.1f}s")
+
+
+def build_partitions(chunks, embeddings, index_spec, train_size=DEFAULT_TRAIN_SIZE, storage="float32"):
+    """
+    Builds one sub-index per source ("pubmed", "clinicaltrials"), of
+    the same type as the main index. Each one maps back to row ids in
+    the main index, so a query filtered to one source searches just
+    that source's vectors instead of the whole corpus.
+    Returns the partitions' metadata.
+    """
+    sources = np.array([chunk["source"] for chunk in chunks])
+    partitions = {}
+    for source in sorted(set(sources)):
+        ids = np.flatnonzero(sources == source).astype("int64")
+        # With only one source the main index already is the partition
+        if len(ids) == len(chunks):
+            continue
+
+        vectors = embeddings[ids]
+        sub_index, factory, search_params, _ = make_index(
+            index_spec, embeddings.shape[1], min(len(ids), train_size), storage=storage
+        )
+        train_index(sub_index, vectors, train_size=train_size)
+        partition = faiss.IndexIDMap2(sub_index)
+        partition.add_with_ids(vectors, ids)
+
+        path = partition_path(source)
+        faiss.write_index(partition, staged_path(path))
+        partitions[source] = {
+            "path": path,
+            "factory": factory,
+            "ntotal": int(partition.ntotal),
+            "search_params": search_params
+        }
+        print(f"  {source} partition ({factory}): {partition.ntotal} vectors")
+    return partitions
+
+
+def load_chunks(chunks_path):
+    """
+    Reads chunks from either the pretty-printed chunks.json
+    or the JSON lines file written by chunk_and_embed.py --parallel.
+    """
+    with open(chunks_path) as f:
+        if chunks_path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def build_index(chunks_path="data/chunks.json", use_cache=True, index_spec="flat",
+                train_size=DEFAULT_TRAIN_SIZE, storage="float32", workers=None):
     """
     Loads all chunks, embeds them using sentence-transformers,
     and saves a FAISS index to disk so we can search it later.
+
+    index_spec picks the index type (see INDEX_TYPES), e.g. "flat",
+    "ivf_flat:nlist=1024", "ivf_pq:m=48,nprobe=16" or "hnsw:m=32,efSearch=128".
+    storage picks how the vectors are stored (see STORAGE_TYPES).
+    workers > 0 embeds new chunks with that many processes (see bulk_embed.py).
     """
     print("Loading chunks...")
-    with open(chunks_path) as f:
-        chunks = json.load(f)
+    chunks = load_chunks(chunks_path)
 
     # Extract just the text from each chunk
     # This is what gets embedded
     texts = [chunk["text"] for chunk in chunks]
-    print(f"Embedding {len(texts)} chunks — this may take a few minutes...")
-
-    # Convert all texts to vectors
-    # show_progress_bar gives you a live progress indicator
-    embeddings = model.encode(
-        texts,
-        show_progress_bar=True,
-        batch_size=64
-    )
+    print(f"Embedding {len(texts)} chunks...")
 
-    # Convert to float32 — FAISS requires this specific type
-    embeddings = np.array(embeddings).astype("float32")
+    # Convert all texts to vectors (float32 — FAISS requires this specific type)
+    embeddings = embed_chunks(texts, use_cache=use_cache, workers=workers)
 
     print(f"\nEmbedding shape: {embeddings.shape}")
     print(f"  {embeddings.shape[0]} chunks embedded")
     print(f"  {embeddings.shape[1]} dimensions per vector")
 
     # Build the FAISS index
-    # IndexFlatL2 uses L2 (euclidean) distance to find
+    # Every index type uses L2 (euclidean) distance to find
     # the most similar vectors to a query
     dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
+    index, factory, search_params, storage = make_index(
+        index_spec, dimension, min(len(embeddings), train_size), storage=storage
+    )
+    train_index(index, embeddings, train_size=train_size)
     index.add(embeddings)
+    # Filtered searches score small candidate sets straight from
+    # the stored vectors, which IVF indexes need a direct map for
+    enable_reconstruct(index)
 
-    print(f"\nFAISS index built with {index.ntotal} vectors")
+    print(f"\nFAISS index ({factory}) built with {index.ntotal} vectors")
+    if search_params:
+        print(f"  Default search parameters: {search_params}")
 
-    # Save everything to disk
+    print("\nBuilding per-source partitions...")
     os.makedirs("data", exist_ok=True)
-    faiss.write_index(index, "data/faiss_index.bin")
+    partitions = build_partitions(chunks, embeddings, index_spec, train_size=train_size, storage=storage)
+
+    # Anything but a float32 flat index is approximate, so measure
+    # what it costs against exact search before we ship it
+    recall = None
+    if factory != "Flat":
+        # Measure with the nprobe/efSearch the pipeline will search with,
+        # not FAISS's defaults
+        apply_search_params(index, search_params)
+        recall = measure_recall(index, embeddings)
+        print(f"\nRecall@10 against exact flat search: {recall:.3f}")
+
+    # Save everything to disk, with the search parameters stored
+    # next to the index so rag_pipeline queries it the same way
+    meta = {
+        "spec": index_spec,
+        "factory": factory,
+        "metric": "l2",
+        "model": MODEL_NAME,
+        "dimension": dimension,
+        "ntotal": int(index.ntotal),
+        "search_params": search_params,
+        "storage": storage,
+        "recall_at_10": round(recall, 4) if recall is not None else None,
+        "partitions": partitions
+    }
+    # Every file is written next to the live one first and only
+    # swapped in at the end (see publish), so an app answering
+    # questions during the rebuild never mixes old and new files
+    save_index(index, meta, staged_path(INDEX_PATH), staged_path(INDEX_META_PATH))
+
+    # How much memory the index takes compared with the raw float32
+    # vectors every serving process used to load
+    index_bytes = os.path.getsize(staged_path(INDEX_PATH))
+    float32_bytes = embeddings.shape[0] * dimension * 4
+    meta.update(index_bytes=index_bytes, float32_bytes=float32_bytes)
+    save_index_meta(meta, staged_path(INDEX_META_PATH))
+    print(f"Index size: {index_bytes / 1e6:.1f} MB, {index_bytes / max(float32_bytes, 1):.2f}x "
+          f"the {float32_bytes / 1e6:.1f} MB of raw float32 vectors")
+
+    # Keyword index over the same rows, for hybrid retrieval —
+    # exact names like "BPC-157" or NCT IDs are found by lookup
+    # rather than hoping they land near the query embedding
+    BM25Index.build(texts).save(staged_path(BM25_INDEX_PATH))
+
+    # Which chunks have which source, NCT ID, PMID and search query,
+    # so retrieve() can resolve filters without touching the chunks
+    MetadataIndex.build(chunks).save(staged_path(METADATA_INDEX_PATH))
 
     # Save the chunks separately so we can look up
-    # the original text after finding a match
-    with open("data/chunks_indexed.json", "w") as f:
+    # the original text after finding a match.
+    # chunks.bin is what the app reads (memory-mapped, decoded lazily);
+    # chunks_indexed.json is kept as a human-readable copy
+    write_chunk_store(chunks, staged_path(CHUNK_STORE_PATH))
+    with open(staged_path(CHUNKS_JSON_PATH), "w") as f:
         json.dump(chunks, f, indent=2)
 
-    print("Saved faiss_index.bin and chunks_indexed.json")
+    publish([INDEX_PATH, INDEX_META_PATH, *(p["path"] for p in partitions.values()),
+             BM25_INDEX_PATH, METADATA_INDEX_PATH, CHUNK_STORE_PATH, CHUNKS_JSON_PATH])
+
+    print("Saved faiss_index.bin, faiss_index.json, source partitions, bm25_index.npz, "
+          "metadata_index.npz, chunks.bin, chunks_indexed.json and index_manifest.json")
     return index, chunks
 
 
 if __name__ == "__main__":
-    build_index()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Embed chunks and build the FAISS index")
+    parser.add_argument("--chunks", default="data/chunks.json",
+                        help="chunks file to index (.json or .jsonl)")
+    parser.add_argument("--index", default="flat",
+                        help="index spec: flat, ivf_flat, ivf_pq or hnsw, with optional "
+                             "options e.g. 'ivf_pq:nlist=1024,m=48,nprobe=16'")
+    parser.add_argument("--storage", default="float32", choices=list(STORAGE_TYPES),
+                        help="how vectors are stored: float32, fp16, sq8 or pq")
+    parser.add_argument("--train-size", type=int, default=DEFAULT_TRAIN_SIZE,
+                        help="number of vectors to train IVF/PQ indexes on")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="embed with this many processes, batching chunks of similar length "
+                             "(default: one process)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="re-encode every chunk instead of reusing cached embeddings")
+    args = parser.parse_args()
+
+    build_index(chunks_path=args.chunks, use_cache=not args.no_cache,
+                index_spec=args.index, train_size=args.train_size, storage=args.storage,
+                workers=args.workers)
@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# all-MiniLM-L6-v2 never looks past 256 word pieces, so longer
+# chunks all cost the same and go in the same bucket
+MAX_SEQ_LENGTH = 256
+
+# Each worker process holds its own copy of the model
+_worker_model = None
+
+
+def token_lengths(texts, model_name):
+    """
+    Number of word pieces the model will see for each text. Falls back
+    to a character-based estimate if the tokenizer can't be loaded.
+    """
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(f"sentence-transformers/{model_name}")
+        lengths = [len(ids) for ids in tokenizer(list(texts), add_special_tokens=True)["input_ids"]]
+    except Exception as e:
+        print(f"Couldn't load the {model_name} tokenizer ({type(e).__name__}), sorting by characters instead")
+        lengths = [len(text) // 4 + 2 for text in texts]
+    return np.minimum(np.array(lengths, dtype="int64"), MAX_SEQ_LENGTH)
+
+
+def _init_worker(model_name, threads):
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    # Split the cores between the workers instead of every worker
+    # starting a thread per core and fighting over them
+    torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(model_name, device="cpu")
+
+
+def _embed_batch(texts):
+    vectors = _worker_model.encode(texts, batch_size=len(texts), show_progress_bar=False)
+    return np.asarray(vectors, dtype="float32")
+
+
+def bulk_embed(texts, model_name, output_path, workers=None, batch_size=64):
+    """
+    Embeds texts across a pool of worker processes and writes the
+    vectors into a float32 memmap at output_path, row i for text i.
+    Returns the memmap.
+
+    Texts are sorted by token length before batching, so each batch
+    holds texts of about the same length and almost no time goes into
+    encoding padding. The longest batches go out first so no worker
+    is left with a slow batch at the very end.
+    """
+    workers = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    start = time.time()
+
+    lengths = token_lengths(texts, model_name)
+    order = np.argsort(-lengths, kind="stable")
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    padded = sum(int(lengths[batch].max()) * len(batch) for batch in batches)
+    print(f"Embedding {len(texts)} chunks with {workers} workers x {threads} threads "
+          f"({100 * lengths.sum() / max(padded, 1):.0f}% of encoded tokens are real, not padding)")
+
+    output = None
+    done = 0
+    batches_done = 0
+
+    def write(batch, future):
+        nonlocal output, done, batches_done
+        vectors = future.result()
+        if output is None:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            output = np.memmap(output_path, dtype="float32", mode="w+", shape=(len(texts), vectors.shape[1]))
+        output[batch] = vectors
+        done += len(batch)
+        batches_done += 1
+        if batches_done % 50 == 0 or done == len(texts):
+            elapsed = time.time() - start
+            print(f"  {done}/{len(texts)} chunks ({done / max(elapsed, 1e-9):.0f} chunks/s)")
+
+    # spawn rather than fork: the parent may already have imported torch
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(model_name, threads)) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, pool.submit(_embed_batch, [texts[i] for i in batch])))
+            # Keep a couple of batches queued per worker, no more
+            if len(pending) >= workers * 2:
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+
+    if output is None:
+        return np.zeros((0, 0), dtype="float32")
+    output.flush()
+
+    elapsed = time.time() - start
+    print(f"Embedded {len(texts)} chunks in {elapsed:.1f}s ({len(texts) / max(elapsed, 1e-9):.0f} chunks/s)")
+    return output
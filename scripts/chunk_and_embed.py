@@ -1,40 +1,49 @@
+import argparse
 import json
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import re
 
-def clean_text(text):
-    """
-    Removes PubMed citation noise from chunks.
-    Things like author lists, DOI lines, PMID lines,
-    and journal headers that don't contain useful content.
-    """
+# Cleaning rules, compiled once when the module loads instead of
+# on every clean_text call. They run in order, top to bottom.
+CLEANING_RULES = [
     # Remove DOI lines
-    text = re.sub(r'DOI:.*?\n', '', text)
-    
+    (re.compile(r'DOI:.*?\n'), ''),
+
     # Remove PMID lines
-    text = re.sub(r'PMID:.*?\n', '', text)
-    
+    (re.compile(r'PMID:.*?\n'), ''),
+
     # Remove PMCID lines
-    text = re.sub(r'PMCID:.*?\n', '', text)
-    
+    (re.compile(r'PMCID:.*?\n'), ''),
+
     # Remove author information lines
-    text = re.sub(r'Author information:.*?\n', '', text)
-    
+    (re.compile(r'Author information:.*?\n'), ''),
+
     # Remove conflict of interest statements
-    text = re.sub(r'Conflict of interest.*?(\n\n|\Z)', '', text, flags=re.DOTALL)
-    
+    (re.compile(r'Conflict of interest.*?(\n\n|\Z)', flags=re.DOTALL), ''),
+
     # Remove copyright lines
-    text = re.sub(r'Copyright ©.*?\n', '', text)
-    
+    (re.compile(r'Copyright ©.*?\n'), ''),
+
     # Remove lines that are just numbers and punctuation (citation numbers)
-    text = re.sub(r'^\d+\.\s*\n', '', text, flags=re.MULTILINE)
-    
+    (re.compile(r'^\d+\.\s*\n', flags=re.MULTILINE), ''),
+
     # Remove excessive whitespace
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = text.strip()
-    
-    return text
+    (re.compile(r'\n{3,}'), '\n\n'),
+]
+
+def clean_text(text):
+    """
+    Removes PubMed citation noise from chunks.
+    Things like author lists, DOI lines, PMID lines,
+    and journal headers that don't contain useful content.
+    """
+    for pattern, replacement in CLEANING_RULES:
+        text = pattern.sub(replacement, text)
+    return text.strip()
 
 # This is the splitter we'll use to break text into chunks.
 # chunk_size: maximum size of each chunk in characters
@@ -46,44 +55,247 @@ splitter = RecursiveCharacterTextSplitter(
     chunk_overlap=150
 )
 
-def process_pubmed(input_path="data/pubmed_raw.json"):
+# all-MiniLM-L6-v2 only reads the first 256 word pieces of a chunk
+# (two of which are its [CLS] and [SEP] markers). Anything past that
+# is never embedded, so it can't help a chunk get retrieved.
+EMBEDDING_TOKENIZER = "sentence-transformers/all-MiniLM-L6-v2"
+MAX_EMBED_TOKENS = 256
+DEFAULT_CHUNK_TOKENS = MAX_EMBED_TOKENS - 2
+DEFAULT_OVERLAP_TOKENS = 32
+
+
+def load_embedding_tokenizer():
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_TOKENIZER)
+    # We count long texts on purpose, don't warn about them
+    tokenizer.model_max_length = 10 ** 9
+    return tokenizer
+
+
+def use_token_splitter(chunk_tokens=DEFAULT_CHUNK_TOKENS, overlap_tokens=DEFAULT_OVERLAP_TOKENS):
     """
-    Takes the raw PubMed data and splits each query's
-    content blob into individual chunks with metadata.
+    Switches chunking to measure size in the embedding model's own
+    tokens instead of characters, so every chunk fits in what the
+    model actually reads. Call it before chunking anything.
+    """
+    global splitter
+    if chunk_tokens is None:
+        return
+    splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        load_embedding_tokenizer(),
+        chunk_size=chunk_tokens,
+        chunk_overlap=overlap_tokens
+    )
+
+def _keep(chunk):
+    # Skip very short chunks — they're usually
+    # just headers or formatting artifacts
+    return len(chunk.strip()) >= 100
+
+
+def pubmed_entry_chunks(entry):
+    """
+    Chunks one query's content blob from pubmed_raw.json.
     """
-    with open(input_path) as f:
-        data = json.load(f)
+    content = entry["content"]
 
-    all_chunks = []
+    # Skip if content is empty
+    if not content.strip():
+        return []
+
+    #clean
+    content = clean_text(content)
+
+    # Split the big text blob into chunks
+    return [
+        {
+            "text": chunk.strip(),
+            "source": "pubmed",
+            "query": entry["query"]
+        }
+        for chunk in splitter.split_text(content) if _keep(chunk)
+    ]
+
+
+def pubmed_article_chunks(article):
+    """
+    Chunks one article from pubmed_articles.jsonl. Every chunk
+    keeps the article's metadata, including the list of queries
+    that matched it.
+    """
+    abstract = article.get("abstract", "").strip()
+    if not abstract:
+        return []
+
+    # Put the title in front so every chunk of the abstract
+    # embeds with the context of what the paper is about
+    content = clean_text(f"{article.get('title', '')}\n\n{abstract}")
+    queries = article.get("queries", [])
+
+    return [
+        {
+            "text": chunk.strip(),
+            "source": "pubmed",
+            "pmid": article.get("pmid", ""),
+            "title": article.get("title", ""),
+            "year": article.get("year", ""),
+            "journal": article.get("journal", ""),
+            "query": queries[0] if queries else "",
+            "queries": queries
+        }
+        for chunk in splitter.split_text(content) if _keep(chunk)
+    ]
+
+
+def trial_text(trial):
+    """
+    Build a readable text block from the structured fields.
+    This is important — we're converting JSON structure
+    into natural language so it embeds properly.
+    """
+    parts = []
+
+    if trial.get("title"):
+        parts.append(f"Trial Title: {trial['title']}")
+
+    if trial.get("status"):
+        parts.append(f"Status: {trial['status']}")
+
+    if trial.get("phase"):
+        parts.append(f"Phase: {', '.join(trial['phase'])}")
+
+    if trial.get("summary"):
+        parts.append(f"Summary: {trial['summary']}")
+
+    if trial.get("description"):
+        parts.append(f"Description: {trial['description']}")
+
+    if trial.get("interventions"):
+        parts.append(f"Interventions: {', '.join(trial['interventions'])}")
+
+    if trial.get("primary_outcomes"):
+        parts.append(f"Primary Outcomes: {', '.join(trial['primary_outcomes'])}")
 
-    for entry in data:
-        query = entry["query"]
-        content = entry["content"]
+    if trial.get("eligibility"):
+        parts.append(f"Eligibility: {trial['eligibility']}")
 
-        # Skip if content is empty
-        if not content.strip():
-            continue
+    # Join all parts into one text block
+    return "\n\n".join(parts)
 
-        #clean
-        content = clean_text(content)
 
+def trial_chunks(trial):
+    """
+    Chunks one trial from clinicaltrials_raw.json.
+    """
+    full_text = trial_text(trial)
+
+    if not full_text.strip():
+        return []
+
+    # Chunk it — longer trials may produce multiple chunks
+    return [
+        {
+            "text": chunk.strip(),
+            "source": "clinicaltrials",
+            "nct_id": trial.get("nct_id", ""),
+            "title": trial.get("title", ""),
+            "queries": trial.get("search_terms") or [trial.get("search_term", "")]
+        }
+        for chunk in splitter.split_text(full_text) if _keep(chunk)
+    ]
+
+
+# Which chunking function handles each kind of raw record
+CHUNKERS = {
+    "pubmed": pubmed_entry_chunks,
+    "pubmed_article": pubmed_article_chunks,
+    "clinicaltrials": trial_chunks,
+}
 
-        # Split the big text blob into chunks
-        chunks = splitter.split_text(content)
 
-        for chunk in chunks:
-            # Skip very short chunks — they're usually
-            # just headers or formatting artifacts
-            if len(chunk.strip()) < 100:
+# Whitespace between the elements of a JSON array
+WHITESPACE = re.compile(r"\s*")
+
+
+def iter_records(path):
+    """
+    Yields records from a raw data file one at a time without
+    loading the whole file. Handles both JSON lines files and the
+    pretty-printed JSON arrays the collectors write.
+    """
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        # Decode one array element at a time from a rolling buffer.
+        # pos walks through the buffer and the consumed part is only
+        # cut off once per block read, so records aren't re-copied.
+        decoder = json.JSONDecoder()
+        buffer = ""
+        pos = 0
+        started = False
+        eof = False
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            char = buffer[pos:pos + 1]
+            if not started:
+                if char == "[":
+                    pos += 1
+                    started = True
+                    continue
+            elif char == ",":
+                pos += 1
                 continue
+            elif char == "]":
+                return
+            elif char:
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # Probably cut off mid-record — read more and try again
+                    if eof:
+                        raise
+                else:
+                    yield record
+                    continue
+
+            if eof:
+                return
+            block = f.read(1 << 20)
+            eof = not block
+            buffer = buffer[pos:] + block
+            pos = 0
+
 
-            all_chunks.append({
-                "text": chunk.strip(),
-                "source": "pubmed",
-                "query": query
-            })
+def process_pubmed(input_path="data/pubmed_raw.json"):
+    """
+    Takes the raw PubMed data and splits each query's
+    content blob into individual chunks with metadata.
+    """
+    all_chunks = []
+    count = 0
+    for entry in iter_records(input_path):
+        count += 1
+        all_chunks.extend(pubmed_entry_chunks(entry))
+
+    print(f"PubMed: created {len(all_chunks)} chunks from {count} queries")
+    return all_chunks
+
+def process_pubmed_articles(input_path="data/pubmed_articles.jsonl"):
+    """
+    Takes the per-article PubMed records (one JSON object per line,
+    already deduplicated by PMID) and chunks each abstract on its own.
+    """
+    all_chunks = []
+    count = 0
+    for article in iter_records(input_path):
+        count += 1
+        all_chunks.extend(pubmed_article_chunks(article))
 
-    print(f"PubMed: created {len(all_chunks)} chunks from {len(data)} queries")
+    print(f"PubMed: created {len(all_chunks)} chunks from {count} articles")
     return all_chunks
 
 def process_clinicaltrials(input_path="data/clinicaltrials_raw.json"):
@@ -93,68 +305,126 @@ def process_clinicaltrials(input_path="data/clinicaltrials_raw.json"):
     structured so we build a readable text block per trial first,
     then chunk it.
     """
-    with open(input_path) as f:
-        data = json.load(f)
-
     all_chunks = []
+    count = 0
+    for trial in iter_records(input_path):
+        count += 1
+        all_chunks.extend(trial_chunks(trial))
 
-    for trial in data:
-        # Build a readable text block from the structured fields
-        # This is important — we're converting JSON structure
-        # into natural language so it embeds properly
-        parts = []
-
-        if trial.get("title"):
-            parts.append(f"Trial Title: {trial['title']}")
-
-        if trial.get("status"):
-            parts.append(f"Status: {trial['status']}")
-
-        if trial.get("phase"):
-            parts.append(f"Phase: {', '.join(trial['phase'])}")
-
-        if trial.get("summary"):
-            parts.append(f"Summary: {trial['summary']}")
-
-        if trial.get("description"):
-            parts.append(f"Description: {trial['description']}")
-
-        if trial.get("interventions"):
-            parts.append(f"Interventions: {', '.join(trial['interventions'])}")
+    print(f"ClinicalTrials: created {len(all_chunks)} chunks from {count} trials")
+    return all_chunks
 
-        if trial.get("primary_outcomes"):
-            parts.append(f"Primary Outcomes: {', '.join(trial['primary_outcomes'])}")
 
-        if trial.get("eligibility"):
-            parts.append(f"Eligibility: {trial['eligibility']}")
+def _chunk_batch(batch):
+    """
+    Runs in a worker process: chunks a batch of (kind, record) pairs.
+    """
+    return [chunk for kind, record in batch for chunk in CHUNKERS[kind](record)]
 
-        # Join all parts into one text block
-        full_text = "\n\n".join(parts)
 
-        if not full_text.strip():
-            continue
+def _batches(jobs, size):
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-        # Chunk it — longer trials may produce multiple chunks
-        chunks = splitter.split_text(full_text)
 
-        for chunk in chunks:
-            if len(chunk.strip()) < 100:
-                continue
+def chunk_parallel(sources, output_path="data/chunks.jsonl", workers=None, batch_size=64,
+                   chunk_tokens=None, overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+    """
+    Streams raw records from each (kind, path) in `sources`, fans
+    cleaning and splitting out to a process pool and appends the
+    chunks to a JSON lines file as soon as each batch comes back.
 
-            all_chunks.append({
-                "text": chunk.strip(),
-                "source": "clinicaltrials",
-                "nct_id": trial.get("nct_id", ""),
-                "title": trial.get("title", "")
-            })
+    Only a few batches are in flight at a time, so memory stays
+    flat however big the corpus is, and output order always
+    matches input order.
 
-    print(f"ClinicalTrials: created {len(all_chunks)} chunks from {len(data)} trials")
-    return all_chunks
+    chunk_tokens switches the workers to token-based splitting
+    (see use_token_splitter).
+    """
+    workers = workers or os.cpu_count() or 1
+    jobs = ((kind, record) for kind, path in sources for record in iter_records(path))
+    counts = {}
+    start = time.time()
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w") as out, ProcessPoolExecutor(
+        max_workers=workers, initializer=use_token_splitter, initargs=(chunk_tokens, overlap_tokens)
+    ) as pool:
+        pending = deque()
+
+        def write(future):
+            for chunk in future.result():
+                out.write(json.dumps(chunk) + "\n")
+                counts[chunk["source"]] = counts.get(chunk["source"], 0) + 1
+
+        for batch in _batches(jobs, batch_size):
+            pending.append(pool.submit(_chunk_batch, batch))
+            # Keep a couple of batches queued per worker, no more
+            if len(pending) >= workers * 2:
+                write(pending.popleft())
+
+        while pending:
+            write(pending.popleft())
+
+    total = sum(counts.values())
+    elapsed = time.time() - start
+    print(f"Chunked with {workers} workers in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} chunks/s)")
+    return counts
+
+def truncation_report(chunks_path, max_tokens=MAX_EMBED_TOKENS, batch_size=1000):
+    """
+    Measures every chunk in the embedding model's tokens and reports
+    how many are longer than it reads, and how much text that leaves
+    unembedded. Returns the numbers as a dictionary.
+    """
+    tokenizer = load_embedding_tokenizer()
+    lengths = []
+    texts = []
+    for chunk in iter_records(chunks_path):
+        texts.append(chunk["text"])
+        if len(texts) == batch_size:
+            lengths.extend(len(ids) for ids in tokenizer(texts)["input_ids"])
+            texts = []
+    if texts:
+        lengths.extend(len(ids) for ids in tokenizer(texts)["input_ids"])
+
+    total_tokens = sum(lengths)
+    truncated = [length for length in lengths if length > max_tokens]
+    lost_tokens = sum(length - max_tokens for length in truncated)
+    report = {
+        "chunks": len(lengths),
+        "truncated_chunks": len(truncated),
+        "truncated_fraction": round(len(truncated) / max(len(lengths), 1), 4),
+        "tokens": total_tokens,
+        "unembedded_tokens": lost_tokens,
+        "unembedded_fraction": round(lost_tokens / max(total_tokens, 1), 4),
+        "max_tokens": max(lengths, default=0)
+    }
+
+    print(f"\nTruncation report for {chunks_path} ({max_tokens}-token embedding limit):")
+    print(f"  Chunks over the limit: {report['truncated_chunks']} of {report['chunks']} "
+          f"({100 * report['truncated_fraction']:.1f}%)")
+    print(f"  Tokens never embedded: {report['unembedded_tokens']} of {report['tokens']} "
+          f"({100 * report['unembedded_fraction']:.1f}%)")
+    print(f"  Longest chunk: {report['max_tokens']} tokens")
+    return report
 
 
 def main():
     print("Processing PubMed data...")
-    pubmed_chunks = process_pubmed()
+    # Prefer the deduplicated per-article file when it exists
+    # (pubmed_collector.py --articles), otherwise fall back to
+    # the older one-blob-per-query format
+    if os.path.exists("data/pubmed_articles.jsonl"):
+        pubmed_chunks = process_pubmed_articles()
+    else:
+        pubmed_chunks = process_pubmed()
 
     print("\nProcessing ClinicalTrials data...")
     trial_chunks = process_clinicaltrials()
@@ -173,5 +443,52 @@ def main():
     print(f"\nSaved to data/chunks.json")
 
 
+def main_parallel(output_path="data/chunks.jsonl", workers=None, chunk_tokens=None,
+                  overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+    """
+    Streaming, multi-process version of main(). Writes chunks
+    as JSON lines instead of one big pretty-printed file.
+    """
+    if os.path.exists("data/pubmed_articles.jsonl"):
+        sources = [("pubmed_article", "data/pubmed_articles.jsonl")]
+    else:
+        sources = [("pubmed", "data/pubmed_raw.json")]
+    sources.append(("clinicaltrials", "data/clinicaltrials_raw.json"))
+
+    counts = chunk_parallel(sources, output_path=output_path, workers=workers,
+                            chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens)
+
+    print(f"\nDone! Total chunks saved: {sum(counts.values())}")
+    print(f"  PubMed chunks:        {counts.get('pubmed', 0)}")
+    print(f"  ClinicalTrials chunks: {counts.get('clinicaltrials', 0)}")
+    print(f"\nSaved to {output_path}")
+    print(f"Build the index with: python scripts/build_index.py --chunks {output_path}")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Clean and chunk the raw PubMed and ClinicalTrials data")
+    parser.add_argument("--parallel", action="store_true",
+                        help="stream records through a process pool and write data/chunks.jsonl")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes for --parallel (default: all cores)")
+    parser.add_argument("--chunk-tokens", type=int, nargs="?", const=DEFAULT_CHUNK_TOKENS, default=None,
+                        help="size chunks in embedding-model tokens instead of 1500 characters "
+                             f"(default when given: {DEFAULT_CHUNK_TOKENS}, to fit the "
+                             f"{MAX_EMBED_TOKENS}-token model limit)")
+    parser.add_argument("--overlap-tokens", type=int, default=DEFAULT_OVERLAP_TOKENS,
+                        help="token overlap between chunks with --chunk-tokens")
+    parser.add_argument("--report", action="store_true",
+                        help="after chunking, report how much text the embedding model would truncate")
+    args = parser.parse_args()
+
+    if args.parallel:
+        main_parallel(workers=args.workers, chunk_tokens=args.chunk_tokens,
+                      overlap_tokens=args.overlap_tokens)
+        output_path = "data/chunks.jsonl"
+    else:
+        use_token_splitter(args.chunk_tokens, args.overlap_tokens)
+        main()
+        output_path = "data/chunks.json"
+
+    if args.report:
+        truncation_report(output_path)
\ No newline at end of file
@@ -0,0 +1,99 @@
+import json
+import mmap
+import os
+
+import numpy as np
+
+CHUNK_STORE_PATH = "data/chunks.bin"
+CHUNKS_JSON_PATH = "data/chunks_indexed.json"
+
+# File layout:
+#   8 bytes   magic
+#   8 bytes   number of chunks (n), little-endian uint64
+#   8*(n+1)   offsets table — chunk i lives at blob[offsets[i]:offsets[i+1]]
+#   ...       blob of UTF-8 JSON records, one per chunk, back to back
+MAGIC = b"PCHUNKS1"
+HEADER_SIZE = 16
+
+
+def write_chunk_store(chunks, path=CHUNK_STORE_PATH):
+    """
+    Writes chunks (text plus metadata) to the compact binary store.
+    Row i in the store is row i in the FAISS index.
+    """
+    records = [json.dumps(chunk, separators=(",", ":")).encode("utf-8") for chunk in chunks]
+    offsets = np.zeros(len(records) + 1, dtype="<u8")
+    np.cumsum([len(r) for r in records], out=offsets[1:])
+
+    # Write to a temp file and swap it in, so a running app never
+    # maps a half-written store
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.array([len(records)], dtype="<u8").tobytes())
+        f.write(offsets.tobytes())
+        for record in records:
+            f.write(record)
+    os.replace(tmp_path, path)
+
+
+class ChunkStore:
+    """
+    Read-only, memory-mapped view of the chunk store.
+
+    Opening it only reads the header; each chunk is decoded when
+    it's asked for. Retrieval only ever touches k chunks per query,
+    so memory use and start-up time don't grow with the corpus, and
+    every process mapping the file shares the same pages.
+    """
+
+    def __init__(self, path=CHUNK_STORE_PATH):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:8] != MAGIC:
+            raise ValueError(f"{path} is not a chunk store")
+        self._count = int(np.frombuffer(self._mm, dtype="<u8", count=1, offset=8)[0])
+        self._offsets = np.frombuffer(self._mm, dtype="<u8", count=self._count + 1, offset=HEADER_SIZE)
+        self._blob_start = HEADER_SIZE + 8 * (self._count + 1)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(f"chunk {i} out of range")
+        start = self._blob_start + int(self._offsets[i])
+        end = self._blob_start + int(self._offsets[i + 1])
+        return json.loads(self._mm[start:end])
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def close(self):
+        # The offsets array is a view into the map, so drop it first
+        self._offsets = None
+        self._mm.close()
+        self._file.close()
+
+    def __del__(self):
+        # A reload doesn't close the old store, since requests may still
+        # be reading it; it's closed here once the last of them is done
+        if hasattr(self, "_mm"):
+            self.close()
+
+
+def open_chunks(store_path=CHUNK_STORE_PATH, json_path=CHUNKS_JSON_PATH):
+    """
+    Opens the binary chunk store, falling back to the old
+    chunks_indexed.json if the index was built before the store existed.
+    Either way the result supports len() and chunks[i].
+    """
+    if os.path.exists(store_path):
+        return ChunkStore(store_path)
+    with open(json_path) as f:
+        return json.load(f)
@@ -1,10 +1,25 @@
-import requests
+import argparse
+import asyncio
 import json
 import os
 import time
 
+import http_cache
+from http_cache import get_cache
+from rate_limit import TokenBucket, fetch_with_retry
+
 BASE_URL = "https://clinicaltrials.gov/api/v2/studies"
 
+# The v2 API allows up to 1000 studies per page
+SYNC_PAGE_SIZE = 1000
+
+# ClinicalTrials.gov doesn't publish a hard limit, but asks
+# clients to be polite — stay well under it
+REQUESTS_PER_SECOND = 5
+
+# Where sync mode remembers the newest lastUpdatePostDate per term
+SYNC_STATE_PATH = "data/clinicaltrials_sync_state.json"
+
 SEARCH_TERMS = [
     "retatrutide",
     "semaglutide obesity weight loss",
@@ -30,7 +45,7 @@ def fetch_trials(search_term, max_results=20):
     }
 
     try:
-        response = requests.get(BASE_URL, params=params, timeout=10)
+        response = get_cache().get(BASE_URL, params=params, timeout=10)
         response.raise_for_status()
         data = response.json()
     except Exception as e:
@@ -38,35 +53,39 @@ def fetch_trials(search_term, max_results=20):
         return []
 
     studies = data.get("studies", [])
-    cleaned = []
-
-    for study in studies:
-        proto = study.get("protocolSection", {})
-
-        # Each trial is broken into modules - we pull
-        # the ones that are useful for our RAG pipeline
-        id_module          = proto.get("identificationModule", {})
-        status_module      = proto.get("statusModule", {})
-        desc_module        = proto.get("descriptionModule", {})
-        design_module      = proto.get("designModule", {})
-        arms_module        = proto.get("armsInterventionsModule", {})
-        outcomes_module    = proto.get("outcomesModule", {})
-        eligibility_module = proto.get("eligibilityModule", {})
-
-        cleaned.append({
-            "nct_id":            id_module.get("nctId", ""),
-            "title":             id_module.get("officialTitle", id_module.get("briefTitle", "")),
-            "status":            status_module.get("overallStatus", ""),
-            "phase":             design_module.get("phases", []),
-            "summary":           desc_module.get("briefSummary", ""),
-            "description":       desc_module.get("detailedDescription", ""),
-            "interventions":     [i.get("name", "") for i in arms_module.get("interventions", [])],
-            "primary_outcomes":  [o.get("measure", "") for o in outcomes_module.get("primaryOutcomes", [])],
-            "eligibility":       eligibility_module.get("eligibilityCriteria", ""),
-            "search_term":       search_term
-        })
-
-    return cleaned
+    return [clean_study(study, search_term) for study in studies]
+
+
+def clean_study(study, search_term):
+    """
+    Flattens one raw study from the API into the dictionary
+    format we store in clinicaltrials_raw.json.
+    """
+    proto = study.get("protocolSection", {})
+
+    # Each trial is broken into modules - we pull
+    # the ones that are useful for our RAG pipeline
+    id_module          = proto.get("identificationModule", {})
+    status_module      = proto.get("statusModule", {})
+    desc_module        = proto.get("descriptionModule", {})
+    design_module      = proto.get("designModule", {})
+    arms_module        = proto.get("armsInterventionsModule", {})
+    outcomes_module    = proto.get("outcomesModule", {})
+    eligibility_module = proto.get("eligibilityModule", {})
+
+    return {
+        "nct_id":            id_module.get("nctId", ""),
+        "title":             id_module.get("officialTitle", id_module.get("briefTitle", "")),
+        "status":            status_module.get("overallStatus", ""),
+        "phase":             design_module.get("phases", []),
+        "summary":           desc_module.get("briefSummary", ""),
+        "description":       desc_module.get("detailedDescription", ""),
+        "interventions":     [i.get("name", "") for i in arms_module.get("interventions", [])],
+        "primary_outcomes":  [o.get("measure", "") for o in outcomes_module.get("primaryOutcomes", [])],
+        "eligibility":       eligibility_module.get("eligibilityCriteria", ""),
+        "last_update":       status_module.get("lastUpdatePostDateStruct", {}).get("date", ""),
+        "search_term":       search_term
+    }
 
 
 def collect_all_trials(output_path="data/clinicaltrials_raw.json"):
@@ -103,5 +122,142 @@ def collect_all_trials(output_path="data/clinicaltrials_raw.json"):
     return unique_trials
 
 
+async def stream_trials(search_term, limiter, since=None, page_size=SYNC_PAGE_SIZE):
+    """
+    Async generator that yields every page of results for a search
+    term, following nextPageToken until the API runs out of pages.
+    If `since` is given (YYYY-MM-DD) only studies updated on or
+    after that date are returned.
+    """
+    params = {
+        "query.term": search_term,
+        "pageSize": page_size,
+        "format": "json"
+    }
+    if since:
+        params["filter.advanced"] = f"AREA[LastUpdatePostDate]RANGE[{since},MAX]"
+
+    while True:
+        response = await fetch_with_retry(BASE_URL, params, limiter, label=f"trials '{search_term}'")
+        data = response.json()
+        yield [clean_study(study, search_term) for study in data.get("studies", [])]
+
+        token = data.get("nextPageToken")
+        if not token:
+            break
+        params["pageToken"] = token
+
+
+def merge_trial(store, trial):
+    """
+    Adds or updates a trial in the store (a dict keyed by NCT ID).
+    The first search term that found a trial stays in `search_term`;
+    every term that found it is kept in `search_terms`.
+    """
+    nct_id = trial["nct_id"]
+    if not nct_id:
+        return
+
+    existing = store.get(nct_id)
+    terms = existing.get("search_terms", [existing["search_term"]]) if existing else []
+    if trial["search_term"] not in terms:
+        terms.append(trial["search_term"])
+
+    if existing:
+        trial["search_term"] = existing["search_term"]
+    trial["search_terms"] = terms
+    store[nct_id] = trial
+
+
+async def sync_term(search_term, limiter, store, since=None):
+    """
+    Pulls every page for one search term into the shared store
+    and returns the newest lastUpdatePostDate it saw.
+    """
+    newest = since or ""
+    count = 0
+
+    async for page in stream_trials(search_term, limiter, since=since):
+        for trial in page:
+            merge_trial(store, trial)
+            # Dates are ISO formatted, so string comparison works
+            newest = max(newest, trial["last_update"])
+        count += len(page)
+
+    label = f"changed since {since}" if since else "total"
+    print(f"  '{search_term}': {count} trials {label}")
+    return newest
+
+
+async def sync_trials_async(output_path="data/clinicaltrials_raw.json",
+                            state_path=SYNC_STATE_PATH, full=False):
+    """
+    Incremental sync. The first run (or full=True) downloads every
+    page for every search term. After that, each term only asks for
+    studies updated since the last run and merges them into the
+    stored set by NCT ID, so a nightly run is just a small delta.
+    """
+    store = {}
+    if os.path.exists(output_path):
+        with open(output_path) as f:
+            for trial in json.load(f):
+                store[trial["nct_id"]] = trial
+
+    state = {}
+    if not full and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    limiter = TokenBucket(REQUESTS_PER_SECOND)
+    start = time.time()
+    before = len(store)
+
+    results = await asyncio.gather(
+        *(sync_term(term, limiter, store, since=state.get(term)) for term in SEARCH_TERMS),
+        return_exceptions=True
+    )
+
+    for term, result in zip(SEARCH_TERMS, results):
+        if isinstance(result, Exception):
+            # Leave the old date in place so the next run retries this term
+            print(f"  Error syncing '{term}': {result}")
+        elif result:
+            state[term] = result
+
+    # Write to a temp file first so a crash never leaves a half-written file
+    os.makedirs("data", exist_ok=True)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(list(store.values()), f, indent=2)
+    os.replace(tmp_path, output_path)
+
+    with open(state_path, "w") as f:
+        json.dump(state, f, indent=2)
+
+    print(f"\nDone in {time.time() - start:.1f}s! {len(store)} trials stored "
+          f"({len(store) - before} new) in {output_path}")
+    print(f"HTTP cache: {get_cache().stats()}")
+    return list(store.values())
+
+
 if __name__ == "__main__":
-    collect_all_trials()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Collect ClinicalTrials.gov studies for the peptide knowledge base")
+    parser.add_argument("--sync", action="store_true",
+                        help="fetch every page and only pull studies changed since the last sync")
+    parser.add_argument("--full", action="store_true",
+                        help="with --sync, ignore the saved state and re-download everything")
+    parser.add_argument("--offline", action="store_true",
+                        help="replay responses from the local HTTP cache only, never hit the network")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="bypass the local HTTP cache")
+    args = parser.parse_args()
+
+    if args.offline:
+        http_cache.set_mode("offline")
+    elif args.no_cache:
+        http_cache.set_mode("off")
+
+    if args.sync:
+        asyncio.run(sync_trials_async(full=args.full))
+    else:
+        collect_all_trials()
\ No newline at end of file
@@ -0,0 +1,152 @@
+import os
+import re
+import threading
+
+# Rough characters-per-token for English research text, used when the
+# generator's tokenizer can't be loaded (no transformers, no network)
+CHARS_PER_TOKEN = 3.5
+
+# The budget for retrieved research grows with the number of chunks
+# retrieved: room for each one at the splitter's full 1500 characters,
+# with headroom since tokenizers split drug names, doses and trial IDs
+# finer than the estimate above. So a normal retrieval always fits, and
+# the budget only trims what stitching and de-duplication leave oversized.
+CHUNK_SIZE_CHARS = 1500
+CHUNK_TOKEN_HEADROOM = 1.5
+
+# Never more than the generation model's context window (Mistral 7B
+# Instruct v0.2 takes 32k tokens) minus room for the instructions,
+# the question and the up-to-750-token answer
+CONTEXT_WINDOW_TOKENS = 32768
+PROMPT_RESERVE_TOKENS = 1536
+
+# Set CONTEXT_TOKEN_BUDGET to use a fixed budget instead
+FIXED_TOKEN_BUDGET = os.getenv("CONTEXT_TOKEN_BUDGET")
+
+# Two chunks sharing more than this fraction of their word 5-grams say
+# the same thing (the same abstract found by two queries, or a chunk
+# and its overlapping neighbour), so only the better-ranked one is kept
+NEAR_DUPLICATE_THRESHOLD = 0.6
+
+# Shortest overlap we trust when stitching neighbouring chunks back together
+MIN_SPAN_OVERLAP = 40
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+
+def _load_tokenizer(model_name):
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model_name, token=os.getenv("HF_TOKEN"))
+    except Exception as e:
+        print(f"Couldn't load the {model_name} tokenizer ({type(e).__name__}), estimating token counts instead")
+        return None
+
+
+def count_tokens(text, model_name):
+    """
+    Number of tokens the generation model will see for this text.
+    Uses the model's own tokenizer when it's available, otherwise
+    estimates from the length.
+    """
+    if model_name not in _tokenizers:
+        with _tokenizers_lock:
+            if model_name not in _tokenizers:
+                _tokenizers[model_name] = _load_tokenizer(model_name)
+
+    tokenizer = _tokenizers[model_name]
+    if tokenizer is None:
+        return int(len(text) / CHARS_PER_TOKEN) + 1
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def _document_key(chunk):
+    """Chunks with the same key come from the same abstract or trial."""
+    return (chunk["source"], chunk.get("pmid") or chunk.get("nct_id") or chunk.get("title") or chunk.get("query"))
+
+
+def _shingles(text, size=5):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _merge_spans(first, second):
+    """
+    Joins two chunks of one document if they overlap (the splitter
+    repeats up to 150 characters between neighbouring chunks).
+    Returns the merged text, or None if they don't overlap.
+    """
+    for a, b in ((first, second), (second, first)):
+        if b in a:
+            return a
+        probe = b[:MIN_SPAN_OVERLAP]
+        start = a.find(probe, max(0, len(a) - 400))
+        if len(probe) == MIN_SPAN_OVERLAP and start >= 0 and b.startswith(a[start:]):
+            return a[:start] + b
+    return None
+
+
+def default_token_budget(n_chunks):
+    """
+    Tokens of context to allow for n_chunks retrieved chunks.
+    """
+    if FIXED_TOKEN_BUDGET:
+        return int(FIXED_TOKEN_BUDGET)
+    per_chunk = CHUNK_SIZE_CHARS / CHARS_PER_TOKEN * CHUNK_TOKEN_HEADROOM
+    return min(int(n_chunks * per_chunk), CONTEXT_WINDOW_TOKENS - PROMPT_RESERVE_TOKENS)
+
+
+def pack_context(chunks, model_name, token_budget=None):
+    """
+    Picks what retrieved research goes into the prompt, best-ranked first:
+
+    - overlapping chunks of the same document are stitched into one span
+    - near-duplicates of something already picked are dropped
+    - chunks are added while they fit in token_budget (by default
+      default_token_budget(len(chunks))); one that doesn't fit is
+      skipped in favour of shorter ones further down
+
+    Returns the packed chunks (same keys as the retrieved ones, with
+    "tokens" added), in rank order.
+    """
+    # Stitch neighbouring chunks of the same document together
+    spans = []
+    for chunk in chunks:
+        text = chunk["text"].strip()
+        for span in spans:
+            if _document_key(span) == _document_key(chunk):
+                merged = _merge_spans(span["text"], text)
+                if merged is not None:
+                    span["text"] = merged
+                    break
+        else:
+            spans.append(dict(chunk, text=text))
+
+    if token_budget is None:
+        token_budget = default_token_budget(len(chunks))
+
+    packed = []
+    picked_shingles = []
+    used = 0
+    for span in spans:
+        shingles = _shingles(span["text"])
+        if any(_similarity(shingles, other) >= NEAR_DUPLICATE_THRESHOLD for other in picked_shingles):
+            continue
+
+        tokens = count_tokens(span["text"], model_name)
+        if used + tokens > token_budget:
+            continue
+
+        packed.append(dict(span, tokens=tokens))
+        picked_shingles.append(shingles)
+        used += tokens
+    return packed
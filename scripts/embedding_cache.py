@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+CACHE_DIR = "data/embedding_cache"
+
+
+def text_hash(text):
+    """
+    Hash of a chunk's text. Two chunks with the same text always
+    get the same vector, so this is all we need to key the cache on.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent store of embeddings keyed by (model name, text hash).
+
+    Vectors live in one flat float32 file per model that we only ever
+    append to, and read back through a memory map. A small JSON file
+    maps each text hash to its row in that file. Rebuilding the index
+    then only has to encode chunks whose text we haven't seen before.
+    """
+
+    def __init__(self, model_name, directory=CACHE_DIR):
+        self.model_name = model_name
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self.vectors_path = os.path.join(directory, f"{slug}.f32")
+        self.index_path = os.path.join(directory, f"{slug}.json")
+        os.makedirs(directory, exist_ok=True)
+
+        self.dim = None
+        self.rows = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                saved = json.load(f)
+            self.dim = saved["dim"]
+            self.rows = saved["rows"]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def _matrix(self):
+        """Memory-maps the vectors file as an (n, dim) float32 array."""
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return None
+        n = os.path.getsize(self.vectors_path) // (self.dim * 4)
+        if n == 0:
+            return None
+        return np.memmap(self.vectors_path, dtype="float32", mode="r", shape=(n, self.dim))
+
+    def missing(self, hashes):
+        """Returns the unique hashes that aren't in the cache yet, in first-seen order."""
+        return list(dict.fromkeys(h for h in hashes if h not in self.rows))
+
+    def add(self, hashes, vectors):
+        """
+        Appends new vectors to the store. The vectors go to disk before
+        the row index does, so a crash part way through can only leave
+        a few unused rows behind — never a hash pointing at the wrong vector.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        if len(hashes) == 0:
+            return
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+
+        # New rows start after the last row the index knows about.
+        # Anything past it was left by an append that died before the
+        # index was saved, possibly part way through a vector, so cut
+        # it off to keep every new row on a row boundary.
+        start = max(self.rows.values(), default=-1) + 1
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(start * self.dim * 4)
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        for i, h in enumerate(hashes):
+            self.rows[h] = start + i
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"model": self.model_name, "dim": self.dim, "rows": self.rows}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, hashes):
+        """
+        Returns an (len(hashes), dim) float32 array of cached vectors
+        in the order asked for. Every hash must already be cached.
+        """
+        if not hashes:
+            return np.zeros((0, self.dim or 0), dtype="float32")
+        matrix = self._matrix()
+        return np.asarray(matrix[[self.rows[h] for h in hashes]], dtype="float32")
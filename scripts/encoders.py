@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+# Which query encoder to run. All three produce (near-)identical
+# embeddings of all-MiniLM-L6-v2, so they work with the same index:
+#   torch  the original SentenceTransformer
+#   int8   the same model with its linear layers dynamically
+#          quantized to int8 — faster on CPU, still needs torch
+#   onnx   an exported ONNX copy run with onnxruntime; doesn't import
+#          torch at all, so it also cuts cold start. Set
+#          ONNX_QUANTIZED=1 to use its int8-quantized version.
+ENCODER_BACKENDS = ("torch", "int8", "onnx")
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+ONNX_QUANTIZED = os.getenv("ONNX_QUANTIZED", "0") == "1"
+
+ONNX_DIR = "data/onnx"
+
+# all-MiniLM-L6-v2 truncates its input at 256 word pieces
+MAX_SEQ_LENGTH = 256
+
+# Minimum cosine similarity between an encoder's embeddings and the
+# torch model's, over the parity check sentences
+PARITY_THRESHOLDS = {
+    "onnx": 0.9999,
+    "onnx_int8": 0.99,
+    "int8": 0.99
+}
+
+PARITY_SENTENCES = [
+    "What are the risks of taking BPC-157?",
+    "How does retatrutide cause weight loss?",
+    "Is epitalon backed by real science?",
+    "GHK-Cu copper peptide and skin collagen",
+    "NCT04881760 semaglutide phase 3 trial in adults with obesity",
+    "Thymosin beta-4 promoted tendon healing in a rat model, although human data are limited.",
+    "peptide"
+]
+
+
+class TorchEncoder:
+    """
+    The SentenceTransformer model, optionally with its linear layers
+    dynamically quantized to int8.
+    """
+
+    def __init__(self, model_name, quantize=False, device=None):
+        from sentence_transformers import SentenceTransformer
+        # Dynamic quantization only runs on CPU
+        self.model = SentenceTransformer(model_name, device="cpu" if quantize else device)
+        self.backend = "int8" if quantize else "torch"
+        if quantize:
+            import torch
+            reference = self.encode(PARITY_SENTENCES)
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+            # Check the quantized model against the original it came from
+            quantized = self.encode(PARITY_SENTENCES)
+            similarity = float((quantized * reference).sum(axis=1).min())
+            if similarity < PARITY_THRESHOLDS["int8"]:
+                raise ValueError(f"int8 model failed its parity check: min cosine {similarity:.4f}, "
+                                 f"needs {PARITY_THRESHOLDS['int8']}")
+
+    def encode(self, texts, batch_size=64, **kwargs):
+        return np.array(self.model.encode(texts, batch_size=batch_size, **kwargs)).astype("float32")
+
+
+class OnnxEncoder:
+    """
+    all-MiniLM-L6-v2 exported to ONNX (see export_onnx), run with
+    onnxruntime and the standalone tokenizers library. Mean pooling and
+    normalisation are done here in numpy, as SentenceTransformer would.
+    """
+
+    def __init__(self, model_name, directory=ONNX_DIR, quantized=ONNX_QUANTIZED, verify=True):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_dir = os.path.join(directory, model_name)
+        filename = "model_int8.onnx" if quantized else "model.onnx"
+        self.backend = "onnx_int8" if quantized else "onnx"
+        if verify:
+            check_parity_report(model_dir, self.backend)
+
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, filename), providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+
+    def encode(self, texts, batch_size=64, **kwargs):
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(list(texts[start:start + batch_size]))
+            inputs = {
+                "input_ids": np.array([e.ids for e in encodings], dtype="int64"),
+                "attention_mask": np.array([e.attention_mask for e in encodings], dtype="int64"),
+                "token_type_ids": np.array([e.type_ids for e in encodings], dtype="int64")
+            }
+            token_embeddings = self.session.run(
+                None, {name: value for name, value in inputs.items() if name in self.input_names}
+            )[0]
+
+            # Mean over real tokens, then unit length
+            mask = inputs["attention_mask"][..., None].astype("float32")
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.append(pooled.astype("float32"))
+        return np.vstack(vectors) if vectors else np.zeros((0, 384), dtype="float32")
+
+
+def make_encoder(model_name, backend=ENCODER_BACKEND):
+    """
+    Returns an encoder with an encode(texts) method for the chosen backend.
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend '{backend}', expected one of {', '.join(ENCODER_BACKENDS)}")
+    if backend == "onnx":
+        return OnnxEncoder(model_name)
+    return TorchEncoder(model_name, quantize=backend == "int8")
+
+
+def parity(encoder, reference, sentences=PARITY_SENTENCES):
+    """
+    Lowest cosine similarity between the encoder's and the reference
+    encoder's embeddings of the same sentences.
+    """
+    a = encoder.encode(sentences)
+    b = reference.encode(sentences)
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float((a * b).sum(axis=1).min())
+
+
+def check_parity_report(model_dir, backend):
+    """
+    Refuses to use an exported model that hasn't passed the parity
+    check, so a bad export can't silently degrade retrieval.
+    """
+    path = os.path.join(model_dir, "parity.json")
+    if not os.path.exists(path):
+        raise ValueError(f"No parity report in {model_dir} — run `python scripts/encoders.py --export` first")
+    with open(path) as f:
+        report = json.load(f)
+    if not report.get(backend, {}).get("passed"):
+        raise ValueError(f"The {backend} export in {model_dir} failed its parity check: {report.get(backend)}")
+
+
+def export_onnx(model_name, directory=ONNX_DIR):
+    """
+    Exports the model to ONNX with a dynamically int8-quantized copy,
+    checks both against the torch model and writes parity.json.
+    Needs torch and onnx; serving only needs onnxruntime and tokenizers.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    model_dir = os.path.join(directory, model_name)
+    os.makedirs(model_dir, exist_ok=True)
+    model_path = os.path.join(model_dir, "model.onnx")
+    int8_path = os.path.join(model_dir, "model_int8.onnx")
+
+    torch_encoder = TorchEncoder(model_name, device="cpu")
+    reference = torch_encoder.model
+    transformer = reference[0].auto_model.eval()
+    reference.tokenizer.save_pretrained(model_dir)
+
+    sample = reference.tokenizer(["export sample"], return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic = {"batch": 0, "sequence": 1}
+    print(f"Exporting {model_name} to {model_path}...")
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            tuple(sample[name] for name in names),
+            model_path,
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: dynamic for name in names + ["last_hidden_state"]},
+            opset_version=14
+        )
+    quantize_dynamic(model_path, int8_path, weight_type=QuantType.QInt8)
+
+    report = {}
+    for backend, quantized in (("onnx", False), ("onnx_int8", True)):
+        encoder = OnnxEncoder(model_name, directory, quantized=quantized, verify=False)
+        similarity = parity(encoder, torch_encoder)
+        report[backend] = {
+            "min_cosine": round(similarity, 6),
+            "threshold": PARITY_THRESHOLDS[backend],
+            "passed": similarity >= PARITY_THRESHOLDS[backend]
+        }
+        print(f"  {backend}: min cosine {similarity:.6f} "
+              f"({'ok' if report[backend]['passed'] else 'FAILED'}, needs {PARITY_THRESHOLDS[backend]})")
+
+    with open(os.path.join(model_dir, "parity.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and check the query encoder backends")
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--export", action="store_true",
+                        help="export the model to ONNX (plus an int8 copy) and check parity")
+    parser.add_argument("--check", choices=ENCODER_BACKENDS,
+                        help="compare a backend's embeddings with the torch model")
+    args = parser.parse_args()
+
+    if args.export:
+        export_onnx(args.model)
+    if args.check:
+        similarity = parity(make_encoder(args.model, args.check), make_encoder(args.model, "torch"))
+        backend = "onnx_int8" if args.check == "onnx" and ONNX_QUANTIZED else args.check
+        threshold = PARITY_THRESHOLDS.get(backend, 0.9999)
+        print(f"{args.check}: min cosine {similarity:.6f} against torch (needs {threshold})")
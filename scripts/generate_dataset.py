@@ -1,4 +1,8 @@
+import argparse
+import asyncio
+import hashlib
 import json
+import random
 import time
 import os
 import sys
@@ -9,7 +13,22 @@ load_dotenv()
 # Add scripts directory to path so we can import rag_pipeline
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from rag_pipeline import retrieve, build_prompt, generate_answer
+from rag_pipeline import retrieve_many, build_prompt, generate_answer_async, make_async_client
+from answer_cache import get_answer_cache
+from rate_limit import AdaptiveConcurrency, retry_after_seconds
+
+# How many generation requests to keep in flight at once. The
+# limiter halves this when the API starts returning 429s/5xx
+# and grows it back as requests succeed again.
+DEFAULT_CONCURRENCY = 4
+
+# Attempts per question before we give up on it
+MAX_ATTEMPTS = 5
+
+# Every finished pair is appended here (and fsynced) the moment it's
+# generated. A crashed or interrupted run picks up from this log, and
+# it's compacted into dataset.json at the end of each run.
+LOG_PATH = "data/dataset.log.jsonl"
 
 QUESTIONS = [
     # Retatrutide
@@ -98,108 +117,259 @@ QUESTIONS = [
 ]
 
 
-def generate_dataset(output_path="data/dataset.json"):
-    dataset = []
-    failed = []
+def _error_details(exc):
+    """
+    Pulls the HTTP status and headers out of whatever the
+    client raised (huggingface_hub and aiohttp errors differ).
+    """
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(exc, "status", None)
+    headers = getattr(response, "headers", None) or getattr(exc, "headers", None)
+    return status, headers
+
 
-    for i, question in enumerate(QUESTIONS):
-        print(f"\n[{i+1}/{len(QUESTIONS)}] {question}")
+def _is_retryable(exc, status):
+    # Rate limiting, server errors and dropped connections are worth
+    # retrying; anything else (bad token, bad request) won't get better
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(exc, (asyncio.TimeoutError, ConnectionError, OSError))
 
+
+async def _generate_one(question, retrieved, client, limiter, max_attempts=MAX_ATTEMPTS, cache=None):
+    """
+    Generates one answer, retrying with backoff when the API pushes
+    back. Returns the answer, or None if the question failed.
+    """
+    prompt = build_prompt(question, retrieved)
+
+    for attempt in range(1, max_attempts + 1):
+        await limiter.acquire()
         try:
-            # Retrieve relevant chunks
-            retrieved = retrieve(question, k=5)
+            answer = await generate_answer_async(prompt, client, cache=cache)
+        except Exception as e:
+            status, headers = _error_details(e)
+            if not _is_retryable(e, status):
+                await limiter.release()
+                print(f"  Exception for '{question}': {e}")
+                return None
+
+            # Honour Retry-After when the server sends one, otherwise
+            # back off exponentially with a bit of jitter
+            backoff = retry_after_seconds(headers)
+            if backoff is None:
+                backoff = min(60, 2 ** attempt) + random.random()
+            await limiter.release(throttled=True, backoff=backoff)
+
+            if attempt == max_attempts:
+                print(f"  Giving up on '{question}' after {attempt} attempts: {e}")
+                return None
+            print(f"  {status or type(e).__name__} for '{question}', "
+                  f"retrying in {backoff:.1f}s (attempt {attempt}/{max_attempts})")
+            continue
 
-            # Build the prompt
-            prompt = build_prompt(question, retrieved)
+        await limiter.release()
 
-            # Generate the answer
-            answer = generate_answer(prompt)
+        # Skip if answer is an error
+        if answer.startswith("Error:"):
+            print(f"  Failed: {answer}")
+            return None
+        return answer
 
-            # Skip if answer is an error
-            if answer.startswith("Error:"):
-                print(f"  Failed: {answer}")
-                failed.append(question)
-                continue
 
-            # Save the pair
-            dataset.append({
-                "instruction": question,
-                "response": answer
-            })
+async def run_generation(questions, concurrency=DEFAULT_CONCURRENCY, max_attempts=MAX_ATTEMPTS,
+                         log_file=None, cache=None):
+    """
+    Generates answers for every question with up to `concurrency`
+    requests in flight on one shared async client. If `log_file` is
+    given, each pair is appended to it as soon as it's generated.
+    Prompts already in `cache` (an AnswerCache) skip the API call.
+    Returns a list of answers (None for failures) in question order.
+    """
+    # Retrieve relevant chunks for every question up front —
+    # one batched embedding call and one FAISS search for the lot
+    print(f"Retrieving research for {len(questions)} questions...")
+    all_retrieved = retrieve_many(questions, k=5)
+
+    limiter = AdaptiveConcurrency(concurrency)
+    client = make_async_client()
+    start = time.time()
+    completed = 0
+
+    async def run(question, retrieved):
+        nonlocal completed
+        answer = await _generate_one(question, retrieved, client, limiter, max_attempts, cache=cache)
+        if answer is not None and log_file is not None:
+            append_to_log(log_file, question, answer)
+        completed += 1
+        status = f"{len(answer)} chars" if answer else "failed"
+        print(f"[{completed}/{len(questions)}] {question} ({status})")
+        return answer
+
+    try:
+        answers = await asyncio.gather(*(run(q, r) for q, r in zip(questions, all_retrieved)))
+    finally:
+        # Close the client's connection pool
+        close = getattr(client, "close", None)
+        if close is not None:
+            await close()
+
+    elapsed = time.time() - start
+    per_minute = len(questions) / elapsed * 60 if elapsed else 0.0
+    print(f"\nGenerated {sum(a is not None for a in answers)}/{len(questions)} answers "
+          f"in {elapsed:.1f}s ({per_minute:.1f} questions/min)")
+    if cache is not None:
+        print(f"Answer cache: {cache.stats()}")
+    return answers
+
+
+def question_key(question):
+    """
+    Stable ID for a question, used to match log entries to QUESTIONS.
+    """
+    return hashlib.sha256(question.encode("utf-8")).hexdigest()[:16]
 
-            print(f"  Generated answer ({len(answer)} chars)")
 
-            # Wait between API calls to avoid rate limiting
-            time.sleep(2)
+def append_to_log(log_file, question, answer):
+    """
+    Appends one pair to the log and forces it to disk, so once this
+    returns the answer survives a crash or a killed process.
+    """
+    record = {"key": question_key(question), "instruction": question, "response": answer}
+    log_file.write(json.dumps(record) + "\n")
+    log_file.flush()
+    os.fsync(log_file.fileno())
 
-        except Exception as e:
-            print(f"  Exception: {e}")
-            failed.append(question)
-            continue
 
-    # Save dataset
-    os.makedirs("data", exist_ok=True)
-    with open(output_path, "w") as f:
-        json.dump(dataset, f, indent=2)
+def load_log(log_path=LOG_PATH):
+    """
+    Reads the log into a dict of key -> pair. A half-written last
+    line (the process died mid-write) is skipped rather than fatal.
+    """
+    pairs = {}
+    if not os.path.exists(log_path):
+        return pairs
+
+    with open(log_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print("  Skipping a truncated line in the log")
+                continue
+            pairs[record["key"]] = record
+    return pairs
 
-    print(f"\nDone!")
-    print(f"  Successful: {len(dataset)}/{len(QUESTIONS)}")
-    print(f"  Failed: {len(failed)}")
-    if failed:
-        print(f"  Failed questions: {failed}")
-    print(f"  Saved to {output_path}")
 
-    
+def _drop_partial_line(log_path):
+    """
+    If the last run died in the middle of writing a line, cut that
+    fragment off so new records start on a clean line.
+    """
+    if not os.path.exists(log_path):
+        return
+    with open(log_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
 
-def retry_failed(output_path="data/dataset.json"):
+def _seed_log_from_dataset(output_path, log_path):
     """
-    Loads existing dataset and retries any questions
-    that didn't make it into the first run.
+    Datasets generated before the log existed: copy their pairs into
+    a fresh log so we don't pay to generate them again.
     """
+    if os.path.exists(log_path) or not os.path.exists(output_path):
+        return
     with open(output_path) as f:
         existing = json.load(f)
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+    with open(log_path, "a") as log_file:
+        for item in existing:
+            append_to_log(log_file, item["instruction"], item["response"])
+    print(f"Seeded {log_path} with {len(existing)} pairs from {output_path}")
 
-    completed_questions = {item["instruction"] for item in existing}
-    remaining = [q for q in QUESTIONS if q not in completed_questions]
 
-    print(f"Already completed: {len(completed_questions)}")
-    print(f"Remaining: {len(remaining)}")
+def compact_log(log_path=LOG_PATH, output_path="data/dataset.json"):
+    """
+    Writes the final dataset from the log: one pair per question,
+    in QUESTIONS order, followed by any logged questions that have
+    since been removed from the list. The file is swapped in
+    atomically so dataset.json is never half-written.
+    """
+    logged = load_log(log_path)
+    order = [question_key(q) for q in QUESTIONS]
+    known = set(order)
+    order += [key for key in logged if key not in known]
+    dataset = [
+        {"instruction": logged[key]["instruction"], "response": logged[key]["response"]}
+        for key in order if key in logged
+    ]
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(dataset, f, indent=2)
+    os.replace(tmp_path, output_path)
+    return dataset
 
-    if not remaining:
-        print("All questions completed!")
-        return
 
-    new_pairs = []
-    for i, question in enumerate(remaining):
-        print(f"\n[{i+1}/{len(remaining)}] {question}")
-        try:
-            retrieved = retrieve(question, k=5)
-            prompt = build_prompt(question, retrieved)
-            answer = generate_answer(prompt)
+def generate_dataset(output_path="data/dataset.json", concurrency=DEFAULT_CONCURRENCY, log_path=LOG_PATH,
+                     use_cache=True):
+    """
+    Generates answers for every question that isn't in the log yet,
+    then compacts the log into the final dataset. Safe to interrupt
+    and re-run: finished questions are never generated twice.
+    With use_cache, prompts answered before (e.g. in an earlier
+    regeneration) come from the answer cache instead of the API.
+    """
+    os.makedirs("data", exist_ok=True)
+    _seed_log_from_dataset(output_path, log_path)
+    _drop_partial_line(log_path)
 
-            if answer.startswith("Error:"):
-                print(f"  Failed again: {answer}")
-                continue
+    done = load_log(log_path)
+    remaining = [q for q in QUESTIONS if question_key(q) not in done]
+    print(f"Already completed: {len(QUESTIONS) - len(remaining)}")
+    print(f"Remaining: {len(remaining)}")
 
-            new_pairs.append({
-                "instruction": question,
-                "response": answer
-            })
-            print(f"  Success ({len(answer)} chars)")
-            time.sleep(2)
+    failed = []
+    if remaining:
+        with open(log_path, "a") as log_file:
+            cache = get_answer_cache() if use_cache else None
+            answers = asyncio.run(run_generation(remaining, concurrency=concurrency,
+                                                 log_file=log_file, cache=cache))
+        failed = [question for question, answer in zip(remaining, answers) if answer is None]
 
-        except Exception as e:
-            print(f"  Exception: {e}")
-            continue
+    # Save dataset
+    dataset = compact_log(log_path, output_path)
+
+    print(f"\nDone!")
+    print(f"  Successful: {len(dataset)}/{len(QUESTIONS)}")
+    print(f"  Failed: {len(failed)}")
+    if failed:
+        print(f"  Failed questions: {failed}")
+    print(f"  Saved to {output_path}")
+    return failed
 
-    # Merge with existing
-    all_pairs = existing + new_pairs
-    with open(output_path, "w") as f:
-        json.dump(all_pairs, f, indent=2)
+    
 
-    print(f"\nDone! Total pairs now: {len(all_pairs)}")
+def retry_failed(output_path="data/dataset.json", concurrency=DEFAULT_CONCURRENCY, log_path=LOG_PATH,
+                 use_cache=True):
+    """
+    Retries any questions that didn't make it into the log on the
+    first pass. Since generation resumes from the log, this is just
+    another pass over whatever is still missing.
+    """
+    return generate_dataset(output_path, concurrency=concurrency, log_path=log_path, use_cache=use_cache)
 
 if __name__ == "__main__":
-    generate_dataset()
-    print("\nRetrying any failed questions...")
-    retry_failed()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate the instruction/response dataset")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="maximum generation requests in flight at once")
+    parser.add_argument("--no-answer-cache", action="store_true",
+                        help="always call the model, even for prompts answered before")
+    args = parser.parse_args()
+
+    use_cache = not args.no_answer_cache
+    if generate_dataset(concurrency=args.concurrency, use_cache=use_cache):
+        print("\nRetrying any failed questions...")
+        retry_failed(concurrency=args.concurrency, use_cache=use_cache)
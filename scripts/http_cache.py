@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+CACHE_PATH = "data/http_cache.sqlite"
+
+# How long a stored response counts as fresh, per endpoint (URL prefix).
+# Abstracts never change once published, search results and trial
+# listings do, so esearch results are only kept for a few hours.
+# efetch requests list their PMIDs, so their keys stay the same
+# from run to run and the abstracts can be kept for a month.
+ENDPOINT_TTLS = {
+    "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi": 6 * 3600,
+    "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi": 30 * 86400,
+    "https://clinicaltrials.gov/api/v2/studies": 12 * 3600,
+}
+DEFAULT_TTL = 86400
+
+# Parameters that don't change what the server sends back,
+# so they're left out of the cache key (a run with an API key
+# can replay responses recorded without one, and vice versa)
+IGNORED_PARAMS = {"api_key", "tool", "email"}
+
+# "on" uses the cache, "off" bypasses it completely and
+# "offline" replays stored responses only — never touching the network
+CACHE_MODE = os.getenv("HTTP_CACHE_MODE", "on")
+
+
+class CacheMiss(requests.RequestException):
+    """Raised in offline mode when a request has no stored response."""
+
+
+class CachedResponse:
+    """
+    The small part of requests.Response that the collectors use,
+    so cached and live responses can be handled the same way.
+    """
+
+    def __init__(self, url, status_code, headers, content, from_cache):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.from_cache = from_cache
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"HTTP {self.status_code} for {self.url}", response=self)
+
+
+class ResponseCache:
+    """
+    A local SQLite cache of HTTP responses keyed on method, URL and
+    parameters. Fresh entries are served without a network call,
+    stale ones are revalidated with If-None-Match/If-Modified-Since
+    when the server gave us an ETag or Last-Modified header.
+    """
+
+    def __init__(self, path=CACHE_PATH, mode=CACHE_MODE, ttls=None, default_ttl=DEFAULT_TTL):
+        self.path = path
+        self.mode = mode
+        self.ttls = ENDPOINT_TTLS if ttls is None else ttls
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+        # Collectors call us from worker threads, so share one
+        # connection and serialise access with a lock
+        self.lock = threading.Lock()
+        self.db = None
+        if mode != "off":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key           TEXT PRIMARY KEY,
+                    url           TEXT,
+                    status        INTEGER,
+                    headers       TEXT,
+                    body          BLOB,
+                    etag          TEXT,
+                    last_modified TEXT,
+                    stored_at     REAL
+                )
+            """)
+            self.db.commit()
+
+    def cache_key(self, method, url, params):
+        params = {k: v for k, v in (params or {}).items() if k not in IGNORED_PARAMS}
+        raw = json.dumps([method.upper(), url, sorted((k, str(v)) for k, v in params.items())])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def ttl_for(self, url):
+        for prefix, ttl in self.ttls.items():
+            if url.startswith(prefix):
+                return ttl
+        return self.default_ttl
+
+    def _load(self, key):
+        with self.lock:
+            return self.db.execute(
+                "SELECT url, status, headers, body, etag, last_modified, stored_at "
+                "FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _store(self, key, response):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, response.url, response.status_code, json.dumps(dict(response.headers)),
+                 response.content, response.headers.get("ETag"),
+                 response.headers.get("Last-Modified"), time.time())
+            )
+            self.db.commit()
+
+    def _touch(self, key):
+        with self.lock:
+            self.db.execute("UPDATE responses SET stored_at = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+
+    @staticmethod
+    def _from_row(row):
+        url, status, headers, body, _, _, _ = row
+        return CachedResponse(url, status, json.loads(headers), body, from_cache=True)
+
+    def lookup(self, method, url, params=None):
+        """
+        Returns the stored response if it's still fresh, otherwise None.
+        In offline mode any stored response is returned however old it
+        is, and a missing one raises CacheMiss.
+        """
+        if self.mode == "off":
+            return None
+
+        row = self._load(self.cache_key(method, url, params))
+        if self.mode == "offline":
+            if row is None:
+                raise CacheMiss(f"No cached response for {method} {url} {params} (offline mode)")
+            self.hits += 1
+            return self._from_row(row)
+
+        if row is not None and time.time() - row[6] < self.ttl_for(url):
+            self.hits += 1
+            return self._from_row(row)
+        return None
+
+    def fetch(self, method, url, params=None, timeout=30):
+        """
+        Makes the real request, revalidating a stale entry when we can,
+        and stores successful responses.
+        """
+        if self.mode == "offline":
+            return self.lookup(method, url, params)
+
+        send = requests.post if method.upper() == "POST" else requests.get
+        payload = {"data": params} if method.upper() == "POST" else {"params": params}
+        if self.mode == "off":
+            return send(url, timeout=timeout, **payload)
+
+        key = self.cache_key(method, url, params)
+        row = self._load(key)
+        headers = {}
+        if row is not None:
+            if row[4]:
+                headers["If-None-Match"] = row[4]
+            if row[5]:
+                headers["If-Modified-Since"] = row[5]
+
+        response = send(url, headers=headers, timeout=timeout, **payload)
+
+        # 304 Not Modified: what we have is still right, just refresh its age
+        if response.status_code == 304 and row is not None:
+            self._touch(key)
+            self.revalidated += 1
+            return self._from_row(row)
+
+        self.misses += 1
+        if response.status_code == 200:
+            self._store(key, response)
+        return response
+
+    def request(self, method, url, params=None, timeout=30):
+        return self.lookup(method, url, params) or self.fetch(method, url, params, timeout=timeout)
+
+    def get(self, url, params=None, timeout=30):
+        return self.request("GET", url, params, timeout=timeout)
+
+    def post(self, url, data=None, timeout=30):
+        return self.request("POST", url, data, timeout=timeout)
+
+    def stats(self):
+        return f"{self.hits} cached, {self.revalidated} revalidated, {self.misses} fetched"
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Returns the shared cache, creating it on first use.
+    """
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
+
+
+def set_mode(mode):
+    """
+    Switches the shared cache to "on", "off" or "offline".
+    Call this before any requests are made (e.g. from a --offline flag).
+    """
+    global _cache
+    _cache = ResponseCache(mode=mode)
+    return _cache
@@ -0,0 +1,150 @@
+import json
+import os
+import time
+
+import faiss
+
+INDEX_PATH = "data/faiss_index.bin"
+
+# Metadata written next to the index: how it was built and the
+# search-time parameters (nprobe, efSearch) it should be queried with
+INDEX_META_PATH = "data/faiss_index.json"
+
+# Written by build_index after it has swapped in every other file, and
+# listing each one with its mtime and size. The app reloads when this
+# changes, and can tell when it has read files from two different builds.
+INDEX_MANIFEST_PATH = "data/index_manifest.json"
+
+
+def save_index(index, meta, index_path=INDEX_PATH, meta_path=INDEX_META_PATH):
+    """
+    Writes the FAISS index and its metadata side by side.
+    """
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    faiss.write_index(index, index_path)
+    save_index_meta(meta, meta_path)
+
+
+def save_index_meta(meta, meta_path=INDEX_META_PATH):
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def load_index_meta(meta_path=INDEX_META_PATH):
+    """
+    Returns the index metadata, or a flat-index default for
+    indexes built before metadata was written.
+    """
+    if not os.path.exists(meta_path):
+        return {"spec": "flat", "factory": "Flat", "search_params": {}}
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def apply_search_params(index, params):
+    """
+    Sets search-time parameters such as nprobe (IVF) or efSearch
+    (HNSW). ParameterSpace finds the right sub-index for us, so this
+    works for any index the factory built.
+    """
+    space = faiss.ParameterSpace()
+    for name, value in (params or {}).items():
+        space.set_index_parameter(index, name, value)
+
+
+def partition_path(source, index_path=INDEX_PATH):
+    """
+    Where the sub-index for one source lives, e.g. data/faiss_index.pubmed.bin.
+    """
+    root, ext = os.path.splitext(index_path)
+    return f"{root}.{source}{ext}"
+
+
+def enable_reconstruct(index):
+    """
+    Lets an IVF index return stored vectors by id (Flat and HNSW
+    indexes already can). Filtered search uses this to score a small
+    set of chunks directly instead of searching the whole index.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+
+
+def filtered_search_params(index, search_params, ids):
+    """
+    Search parameters that restrict a search to the given ids, while
+    keeping the nprobe/efSearch the index was built with.
+    """
+    selector = faiss.IDSelectorBatch(ids)
+    if faiss.try_extract_index_ivf(index) is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=int(search_params.get("nprobe", 1)))
+    if "efSearch" in search_params:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=int(search_params["efSearch"]))
+    return faiss.SearchParameters(sel=selector)
+
+
+def staged_path(path):
+    """
+    Where build_index writes a file before publish() swaps it in.
+    """
+    return path + ".new"
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def publish(paths, manifest_path=INDEX_MANIFEST_PATH):
+    """
+    Swaps the staged copy of every path into place, then writes the
+    manifest. Nothing is swapped until every file of the build has
+    been written, so the old files stay whole until the very end.
+    """
+    for path in paths:
+        os.replace(staged_path(path), path)
+
+    manifest = {"generation": time.time_ns(), "files": {path: file_stamp(path) for path in paths}}
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def load_manifest(manifest_path=INDEX_MANIFEST_PATH):
+    """
+    Returns the manifest, or None for indexes built before it existed.
+    """
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def manifest_matches(manifest, paths=None):
+    """
+    True if the files on disk (all of them, or just `paths`) are still
+    the ones the manifest lists. False means build_index has swapped
+    in newer files since the manifest was written.
+    """
+    files = manifest["files"]
+    for path in files if paths is None else paths:
+        try:
+            if file_stamp(path) != files.get(path):
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def load_index(index_path=INDEX_PATH, meta_path=INDEX_META_PATH):
+    """
+    Reads the FAISS index, applies the search parameters it was
+    built with and returns (index, metadata).
+    """
+    index = faiss.read_index(index_path)
+    meta = load_index_meta(meta_path)
+    apply_search_params(index, meta.get("search_params"))
+    return index, meta
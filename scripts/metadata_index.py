@@ -0,0 +1,133 @@
+import json
+import os
+
+import numpy as np
+
+from query_cache import normalize_query
+
+METADATA_INDEX_PATH = "data/metadata_index.npz"
+
+
+def normalize_filter_value(field, value):
+    """NCT IDs compare upper case, queries as normalised text, everything else lower case."""
+    if field == "nct_id":
+        return str(value).strip().upper()
+    if field == "query":
+        return normalize_query(value)
+    return str(value).strip().lower()
+
+
+def _values(chunk, field):
+    """
+    The values a chunk has for a filter field, normalised the same
+    way filter values are, so "nct01234567" finds "NCT01234567".
+    """
+    if field == "query":
+        # PubMed chunks list every query that found the article;
+        # trial chunks list every search term that found the trial
+        raw = chunk.get("queries") or [chunk.get("query")]
+        return {normalize_query(value) for value in raw if value}
+    value = chunk.get(field)
+    return {normalize_filter_value(field, value)} if value else set()
+
+
+# Fields retrieve() can filter on
+FILTER_FIELDS = ("source", "nct_id", "pmid", "query")
+
+
+class MetadataIndex:
+    """
+    Maps each filter value to the sorted ids of the chunks that have it.
+
+    Like the BM25 index, every field is stored as flat arrays: the
+    chunks with the i-th value of a field are ids[offsets[i]:offsets[i+1]].
+    Resolving a filter is a dictionary lookup and a slice, however
+    many chunks there are.
+    """
+
+    def __init__(self, fields, n_docs):
+        # field -> (sorted values, offsets, ids)
+        self.fields = fields
+        self.lookup = {
+            field: {value: i for i, value in enumerate(values)}
+            for field, (values, _, _) in fields.items()
+        }
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, chunks):
+        fields = {}
+        for field in FILTER_FIELDS:
+            postings = {}
+            for row, chunk in enumerate(chunks):
+                for value in _values(chunk, field):
+                    postings.setdefault(value, []).append(row)
+
+            values = sorted(postings)
+            offsets = np.zeros(len(values) + 1, dtype="int64")
+            np.cumsum([len(postings[value]) for value in values], out=offsets[1:])
+            ids = np.array([row for value in values for row in postings[value]], dtype="int64")
+            fields[field] = (values, offsets, ids)
+        return cls(fields, len(chunks))
+
+    def save(self, path=METADATA_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays = {"n_docs": np.array(self.n_docs)}
+        for field, (values, offsets, ids) in self.fields.items():
+            arrays[f"{field}_values"] = np.array(json.dumps(values))
+            arrays[f"{field}_offsets"] = offsets
+            arrays[f"{field}_ids"] = ids
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=METADATA_INDEX_PATH):
+        with np.load(path) as data:
+            fields = {
+                field: (
+                    json.loads(str(data[f"{field}_values"])),
+                    data[f"{field}_offsets"],
+                    data[f"{field}_ids"]
+                )
+                for field in FILTER_FIELDS if f"{field}_values" in data
+            }
+            return cls(fields, int(data["n_docs"]))
+
+    def counts(self, field):
+        """How many chunks have each value of a field."""
+        values, offsets, _ = self.fields[field]
+        return dict(zip(values, np.diff(offsets).tolist()))
+
+    def select(self, filters):
+        """
+        Returns the sorted ids of the chunks matching every filter.
+        A filter value can be a single value or a list of values,
+        any of which may match.
+        """
+        selected = None
+        for field, wanted in filters.items():
+            if field not in self.fields:
+                raise ValueError(f"Can't filter on '{field}', expected one of {', '.join(FILTER_FIELDS)}")
+            _, offsets, ids = self.fields[field]
+
+            if isinstance(wanted, str):
+                wanted = [wanted]
+            matches = []
+            for value in wanted:
+                position = self.lookup[field].get(normalize_filter_value(field, value))
+                if position is not None:
+                    matches.append(ids[offsets[position]:offsets[position + 1]])
+            field_ids = np.unique(np.concatenate(matches)) if matches else np.zeros(0, dtype="int64")
+
+            selected = field_ids if selected is None else np.intersect1d(selected, field_ids, assume_unique=True)
+        return selected
+
+
+def load_metadata_index(path=METADATA_INDEX_PATH):
+    """
+    Returns the metadata index, or None if build_index hasn't written one yet.
+    """
+    if not os.path.exists(path):
+        return None
+    return MetadataIndex.load(path)
@@ -1,10 +1,27 @@
+import argparse
+import asyncio
+import io
 import json
-import requests
+import re
 import time
 import os
+import xml.etree.ElementTree as ET
+
+import http_cache
+from http_cache import get_cache
+from rate_limit import TokenBucket, fetch_with_retry
 
 PUBMED_BASE = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 
+# NCBI allows 3 requests/second without an API key and 10 with one.
+# Set NCBI_API_KEY in your environment to get the higher limit.
+NCBI_API_KEY = os.getenv("NCBI_API_KEY")
+REQUESTS_PER_SECOND = 10 if NCBI_API_KEY else 3
+
+# How many abstracts to pull per efetch call in the async collector.
+# NCBI recommends keeping efetch batches to a few hundred records.
+EFETCH_PAGE_SIZE = 200
+
 SEARCH_QUERIES = [
     # GLP-1 / Weight loss peptides
     "retatrutide weight loss clinical trial",
@@ -56,7 +73,7 @@ def search_pubmed(query, max_results=50):
         "retmode": "json"
     }
     
-    response = requests.get(url, params=params)
+    response = get_cache().get(url, params=params, timeout=30)
     data = response.json()
     
     # Add this to see exactly what's coming back
@@ -86,7 +103,7 @@ def fetch_abstracts(pmids):
         "retmode": "text"       # plain text format
     }
     
-    response = requests.get(url, params=params)
+    response = get_cache().get(url, params=params, timeout=30)
     return response.text
 
 
@@ -132,6 +149,291 @@ def collect_all_data(output_path="data/pubmed_raw.json"):
     return all_documents
 
 
+async def _eutils_get(endpoint, params, limiter, method="GET"):
+    """
+    Sends one E-utilities request through the shared rate limiter,
+    adding the API key when we have one.
+    """
+    params = dict(params)
+    if NCBI_API_KEY:
+        params["api_key"] = NCBI_API_KEY
+
+    timeout = 60 if method == "POST" else 30
+    return await fetch_with_retry(f"{PUBMED_BASE}{endpoint}", params, limiter,
+                                  method=method, timeout=timeout, label=endpoint)
+
+
+async def search_pubmed_async(query, limiter, max_results=50):
+    """
+    Runs esearch through the shared rate limiter and returns
+    the PMIDs and the total hit count.
+    """
+    params = {
+        "db": "pubmed",
+        "term": query,
+        "retmax": max_results,
+        "retmode": "json"
+    }
+    response = await _eutils_get("esearch.fcgi", params, limiter)
+    data = response.json()
+
+    if "esearchresult" not in data:
+        print(f"  Unexpected response for '{query}': {data}")
+        return None
+
+    result = data["esearchresult"]
+    return {
+        "ids": result.get("idlist", []),
+        "count": int(result.get("count", 0))
+    }
+
+
+async def fetch_abstracts_paged(search, limiter, max_results=50, page_size=EFETCH_PAGE_SIZE):
+    """
+    Fetches abstracts for a search in pages of `page_size`. All pages
+    for the query go out concurrently (the limiter still keeps us
+    under NCBI's rate limit) and are joined back together in order.
+
+    Pages are fetched by PMID rather than through NCBI's history
+    server. A WebEnv changes with every search, so requests carrying
+    it would never hit the HTTP cache on a later run; a list of PMIDs
+    is the same every time, and abstracts don't change.
+    """
+    ids = search["ids"][:max_results]
+
+    async def fetch_page(start):
+        params = {
+            "db": "pubmed",
+            "id": ",".join(ids[start:start + page_size]),
+            "rettype": "abstract",
+            "retmode": "text"
+        }
+        # POST, since 200 PMIDs make for a long URL
+        response = await _eutils_get("efetch.fcgi", params, limiter, method="POST")
+        return response.text
+
+    pages = await asyncio.gather(*(fetch_page(start) for start in range(0, len(ids), page_size)))
+    return "\n\n".join(pages)
+
+
+async def collect_query(query, limiter, max_results=50):
+    """
+    Searches and fetches a single query. Errors are reported and
+    swallowed so one bad query doesn't sink the whole run.
+    """
+    try:
+        search = await search_pubmed_async(query, limiter, max_results=max_results)
+        if not search or not search["ids"]:
+            print(f"  No results found for '{query}', skipping.")
+            return None
+
+        content = await fetch_abstracts_paged(search, limiter, max_results=max_results)
+    except Exception as e:
+        print(f"  Error collecting '{query}': {e}")
+        return None
+
+    print(f"  Fetched {len(search['ids'])} abstracts for: '{query}'")
+    return {
+        "query": query,
+        "pmids": search["ids"],
+        "content": content
+    }
+
+
+async def collect_all_data_async(output_path="data/pubmed_raw.json", max_results=50,
+                                 requests_per_second=REQUESTS_PER_SECOND):
+    """
+    Async version of collect_all_data. Runs every query in
+    SEARCH_QUERIES at the same time under one shared token bucket,
+    so the total run time is bound by NCBI's rate limit rather
+    than by a fixed sleep after each query.
+    """
+    limiter = TokenBucket(requests_per_second)
+    start = time.time()
+
+    results = await asyncio.gather(
+        *(collect_query(query, limiter, max_results=max_results) for query in SEARCH_QUERIES)
+    )
+
+    # Keep the same output format (and query order) as the serial collector
+    all_documents = [doc for doc in results if doc]
+
+    os.makedirs("data", exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(all_documents, f, indent=2)
+
+    print(f"\nDone in {time.time() - start:.1f}s! Saved {len(all_documents)} query batches to {output_path}")
+    print(f"HTTP cache: {get_cache().stats()}")
+    return all_documents
+
+
+def _element_text(elem):
+    """
+    Returns all the text inside an XML element, including text
+    inside nested tags like <i> or <sup> that PubMed uses in titles.
+    """
+    if elem is None:
+        return ""
+    return " ".join("".join(elem.itertext()).split())
+
+
+def _publication_year(article):
+    """
+    PubMed stores the publication date in a few different shapes.
+    Try the structured Year first, then fall back to MedlineDate
+    (e.g. "2021 Jan-Feb") and finally the electronic ArticleDate.
+    """
+    pub_date = article.find("Journal/JournalIssue/PubDate")
+    if pub_date is not None:
+        year = pub_date.findtext("Year")
+        if year:
+            return year
+        match = re.search(r"\d{4}", pub_date.findtext("MedlineDate") or "")
+        if match:
+            return match.group(0)
+    return article.findtext("ArticleDate/Year") or ""
+
+
+def parse_pubmed_xml(stream):
+    """
+    Streams <PubmedArticle> records out of an efetch XML response
+    and yields one dictionary per article. Elements are cleared as
+    soon as they're processed so memory stays flat however many
+    articles are in the response.
+    """
+    for _, elem in ET.iterparse(stream, events=("end",)):
+        if elem.tag != "PubmedArticle":
+            continue
+
+        citation = elem.find("MedlineCitation")
+        article = citation.find("Article") if citation is not None else None
+        if article is None:
+            elem.clear()
+            continue
+
+        # Structured abstracts come as several labelled sections
+        # (BACKGROUND, METHODS, RESULTS...) — keep the labels
+        sections = []
+        for part in article.findall("Abstract/AbstractText"):
+            text = _element_text(part)
+            if not text:
+                continue
+            label = part.get("Label")
+            sections.append(f"{label}: {text}" if label else text)
+
+        yield {
+            "pmid": citation.findtext("PMID", ""),
+            "title": _element_text(article.find("ArticleTitle")),
+            "abstract": "\n".join(sections),
+            "year": _publication_year(article),
+            "journal": _element_text(article.find("Journal/Title"))
+        }
+        elem.clear()
+
+
+async def fetch_articles(pmids, limiter):
+    """
+    Fetches one batch of PMIDs as XML and returns the parsed articles.
+    Uses POST so large batches don't run into URL length limits.
+    """
+    params = {
+        "db": "pubmed",
+        "id": ",".join(pmids),
+        "retmode": "xml"
+    }
+    response = await _eutils_get("efetch.fcgi", params, limiter, method="POST")
+    # Parsing is CPU work, so keep it off the event loop too
+    return await asyncio.to_thread(lambda: list(parse_pubmed_xml(io.BytesIO(response.content))))
+
+
+async def collect_articles_async(output_path="data/pubmed_articles.jsonl",
+                                 query_map_path="data/pubmed_query_map.json",
+                                 max_results=50, requests_per_second=REQUESTS_PER_SECOND):
+    """
+    Per-article ingestion. Searches every query, then fetches each
+    unique PMID exactly once no matter how many queries matched it.
+    Each article is written as one JSON line with the list of
+    queries that found it, so downstream chunking and embedding
+    only ever sees each abstract once.
+    """
+    limiter = TokenBucket(requests_per_second)
+    start = time.time()
+
+    async def search(query):
+        try:
+            return await search_pubmed_async(query, limiter, max_results=max_results)
+        except Exception as e:
+            print(f"  Error searching '{query}': {e}")
+            return None
+
+    searches = await asyncio.gather(*(search(query) for query in SEARCH_QUERIES))
+
+    # Build both directions of the query <-> PMID mapping.
+    # pmid_queries keeps first-seen order so output is stable between runs.
+    query_map = {}
+    pmid_queries = {}
+    for query, result in zip(SEARCH_QUERIES, searches):
+        ids = result["ids"] if result else []
+        query_map[query] = ids
+        print(f"  Found {len(ids)} articles for: '{query}'")
+        for pmid in ids:
+            pmid_queries.setdefault(pmid, []).append(query)
+
+    total_hits = sum(len(ids) for ids in query_map.values())
+    unique_pmids = list(pmid_queries)
+    print(f"\n{total_hits} search hits -> {len(unique_pmids)} unique articles")
+
+    batches = [unique_pmids[i:i + EFETCH_PAGE_SIZE] for i in range(0, len(unique_pmids), EFETCH_PAGE_SIZE)]
+    tasks = [asyncio.create_task(fetch_articles(batch, limiter)) for batch in batches]
+
+    # All batches download concurrently, but we write them out in
+    # order as each one finishes so the file is identical between runs
+    os.makedirs("data", exist_ok=True)
+    written = 0
+    with open(output_path, "w") as f:
+        for batch, task in zip(batches, tasks):
+            try:
+                articles = await task
+            except Exception as e:
+                print(f"  Error fetching batch of {len(batch)} PMIDs: {e}")
+                continue
+            for article in articles:
+                article["queries"] = pmid_queries.get(article["pmid"], [])
+                f.write(json.dumps(article) + "\n")
+                written += 1
+
+    with open(query_map_path, "w") as f:
+        json.dump(query_map, f, indent=2)
+
+    print(f"\nDone in {time.time() - start:.1f}s! Saved {written} articles to {output_path}")
+    print(f"Query -> PMID mapping saved to {query_map_path}")
+    print(f"HTTP cache: {get_cache().stats()}")
+    return written
+
+
 # This makes the script runnable directly
 if __name__ == "__main__":
-    collect_all_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Collect PubMed abstracts for the peptide knowledge base")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run all queries concurrently under a rate limiter")
+    parser.add_argument("--articles", action="store_true",
+                        help="fetch one deduplicated XML record per PMID (implies --async)")
+    parser.add_argument("--max-results", type=int, default=50,
+                        help="maximum articles per query")
+    parser.add_argument("--offline", action="store_true",
+                        help="replay responses from the local HTTP cache only, never hit the network")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="bypass the local HTTP cache")
+    args = parser.parse_args()
+
+    if args.offline:
+        http_cache.set_mode("offline")
+    elif args.no_cache:
+        http_cache.set_mode("off")
+
+    if args.articles:
+        asyncio.run(collect_articles_async(max_results=args.max_results))
+    elif args.use_async:
+        asyncio.run(collect_all_data_async(max_results=args.max_results))
+    else:
+        collect_all_data()
\ No newline at end of file
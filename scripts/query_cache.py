@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_query(query):
+    """
+    Lowercases a query and collapses whitespace, so "Is BPC-157 safe? "
+    and "is bpc-157  safe?" share a cache entry.
+    """
+    return " ".join(query.lower().split())
+
+
+class LRUCache:
+    """
+    A small thread-safe LRU cache with an optional time-to-live.
+
+    When it's full the least recently used entry is dropped. Entries
+    older than `ttl` seconds are treated as missing. Hits and misses
+    are counted so we can see how much work the cache is saving.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None if it's missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if self.ttl is None or time.monotonic() - stored_at < self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
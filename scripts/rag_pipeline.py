@@ -1,49 +1,308 @@
-import json
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import requests
 import os
-from huggingface_hub import InferenceClient
+import threading
+import time
+from huggingface_hub import AsyncInferenceClient, InferenceClient
 from dotenv import load_dotenv
 
+from context_packer import count_tokens, pack_context
+from index_io import filtered_search_params
+from query_cache import normalize_query
+from resources import get_resources
+from semantic_cache import SemanticCache
+from tracing import PROMPT_TOKENS, span
+
 load_dotenv()
 HF_TOKEN = os.getenv("HF_TOKEN")
 
-# Load everything we built
-model = SentenceTransformer("all-MiniLM-L6-v2")
-index = faiss.read_index("data/faiss_index.bin")
+# The model that writes the answers, and how it's called
+GENERATION_MODEL = "mistralai/Mistral-7B-Instruct-v0.2"
+GENERATION_PARAMS = {
+    "max_tokens": 750,
+    "temperature": 0.3
+}
+
+# How retrieve() finds chunks:
+#   dense   nearest neighbours of the query embedding in the FAISS index
+#   hybrid  dense results fused with BM25 keyword matches, so exact names
+#           like "BPC-157" or NCT IDs are found even when the embedding
+#           doesn't place them near the question
+# Dense is the default; pass mode="hybrid" or set RETRIEVAL_MODE=hybrid
+# to opt in.
+RETRIEVAL_MODES = ("dense", "hybrid")
+DEFAULT_RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
 
-with open("data/chunks_indexed.json") as f:
-    chunks = json.load(f)
+# Hybrid mode takes this many candidates per k from each retriever
+# before fusing, and uses the usual reciprocal-rank fusion constant
+HYBRID_CANDIDATES = 4
+RRF_K = 60
 
-print("RAG pipeline loaded successfully")
+# Filters that match at most this many chunks are scored directly
+# against those chunks' vectors; broader ones search the index with
+# an id selector. Either way the cost doesn't grow with how
+# selective the filter is.
+EXACT_FILTER_LIMIT = 10_000
 
+# Chunk metadata passed through with each result
+DOCUMENT_FIELDS = ("pmid", "nct_id", "title", "query")
 
+# The model, index and chunks are loaded lazily the first time
+# they're needed (see resources.py), so importing this module is
+# cheap. Call resources.warm_up() to load them ahead of the first question.
 
-def retrieve(query, k=5):
+
+def embed_queries(queries):
     """
-    Embeds the query and finds the k most relevant chunks.
-    Returns the chunks with their metadata.
+    Returns an (n, dim) float32 array of query embeddings. Cached
+    queries are looked up; all the rest go through the model in a
+    single batched encode call.
+    """
+    resources = get_resources()
+    if not queries:
+        return np.zeros((0, resources.index.d), dtype="float32")
+
+    cache = resources.query_embedding_cache
+    keys = [normalize_query(q) for q in queries]
+    found = {}
+    missing = {}
+    for query, key in zip(queries, keys):
+        if key in found or key in missing:
+            continue
+        vector = cache.get(key)
+        if vector is None:
+            missing[key] = query
+        else:
+            found[key] = vector
+
+    # Encode each distinct uncached query once, in one batch
+    if missing:
+        with span("encode", queries=len(missing), backend=resources.model.backend):
+            encoded = np.array(resources.model.encode(list(missing.values()))).astype("float32")
+        for key, vector in zip(missing, encoded):
+            cache.put(key, vector)
+            found[key] = vector
+
+    return np.vstack([found[key] for key in keys])
+
+
+def embed_query(query):
     """
-    query_vector = np.array(model.encode([query])).astype("float32")
-    distances, indices = index.search(query_vector, k)
+    Returns the (1, dim) float32 embedding for a query,
+    from the cache when we've seen the same question before.
+    """
+    return embed_queries([query])
+
 
+def cache_stats():
+    """
+    Hit rates for the query embedding and retrieval caches.
+    """
+    return get_resources().cache_stats()
+
+
+def _format_results(chunks, distances, indices, rrf_scores=None):
+    """
+    Turns one row of FAISS output into result dictionaries. score is
+    always the dense L2 distance (None for a hybrid result only BM25
+    found); hybrid results also get their fusion score as rrf_score.
+    """
     results = []
-    for i, idx in enumerate(indices[0]):
+    for i, idx in enumerate(indices):
+        # FAISS pads with -1 when there are fewer than k results
+        if idx < 0:
+            continue
         chunk = chunks[idx]
-        results.append({
+        result = {
+            "id": int(idx),
             "text": chunk["text"],
             "source": chunk["source"],
-            "score": round(float(distances[0][i]), 4)
-        })
+            "score": None if distances[i] is None else round(float(distances[i]), 4)
+        }
+        if rrf_scores is not None:
+            result["rrf_score"] = round(float(rrf_scores[i]), 4)
+        # Which abstract or trial the chunk came from, so the context
+        # packer can stitch neighbouring chunks of it back together
+        for field in DOCUMENT_FIELDS:
+            if chunk.get(field):
+                result[field] = chunk[field]
+        results.append(result)
     return results
 
 
+def score_label(result):
+    """
+    A short description of a result's score for display. Hybrid
+    results show their fusion score too, since the L2 distance alone
+    doesn't explain their rank.
+    """
+    if "rrf_score" not in result:
+        return f"score: {result['score']}"
+    if result["score"] is None:
+        return f"rrf: {result['rrf_score']}, keyword match only"
+    return f"rrf: {result['rrf_score']}, distance: {result['score']}"
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """
+    Merges several ranked lists of chunk ids into one. Each chunk
+    scores 1 / (rrf_k + rank) for every list it appears in, so chunks
+    that rank well in both dense and keyword search come out on top.
+    Returns (scores, ids) for the best k.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking):
+            idx = int(idx)
+            if idx >= 0:
+                fused[idx] = fused.get(idx, 0.0) + 1.0 / (rrf_k + rank + 1)
+
+    best = sorted(fused.items(), key=lambda item: -item[1])[:k]
+    return [score for _, score in best], [idx for idx, _ in best]
+
+
+def _filter_key(filters):
+    """
+    The filters with empty values dropped, in a hashable form
+    for the retrieval cache key.
+    """
+    key = []
+    for field, value in sorted((filters or {}).items()):
+        if not value:
+            continue
+        values = [value] if isinstance(value, str) else value
+        key.append((field, tuple(sorted(str(v).strip().lower() for v in values))))
+    return tuple(key)
+
+
+def _dense_search(snapshot, query_vectors, n, filters, allowed):
+    """
+    FAISS search for the n nearest chunks, restricted to the allowed
+    chunk ids when there are filters. Returns (distances, ids) with
+    rows padded with -1 like a normal FAISS search.
+    """
+    if not filters:
+        return snapshot.index.search(query_vectors, n)
+
+    # A lone source filter is served by that source's own sub-index
+    if list(filters) == ["source"] and len(filters["source"]) == 1:
+        partition = snapshot.partition(filters["source"][0])
+        if partition is not None:
+            return partition.search(query_vectors, n)
+
+    if len(allowed) <= EXACT_FILTER_LIMIT:
+        distances = np.full((len(query_vectors), n), np.inf, dtype="float32")
+        ids = np.full((len(query_vectors), n), -1, dtype="int64")
+        if len(allowed):
+            # Few enough chunks to compare the queries against each one
+            vectors = snapshot.index.reconstruct_batch(allowed)
+            found = min(n, len(allowed))
+            knn_distances, positions = faiss.knn(query_vectors, vectors, found)
+            distances[:, :found] = knn_distances
+            ids[:, :found] = allowed[positions]
+        return distances, ids
+
+    params = filtered_search_params(snapshot.index, snapshot.index_meta.get("search_params", {}), allowed)
+    return snapshot.index.search(query_vectors, n, params=params)
+
+
+def retrieve_many(queries, k=5, mode=DEFAULT_RETRIEVAL_MODE, filters=None):
+    """
+    Retrieves the k most relevant chunks for every query in one go.
+    All uncached queries are embedded in one batch and searched in
+    a single FAISS call, which is much faster than calling
+    retrieve() in a loop for bulk workloads like dataset generation.
+    Returns one result list per query, in the same order.
+
+    mode is "dense" or "hybrid" (see RETRIEVAL_MODES). Hybrid results
+    are ranked by their reciprocal-rank fusion score, returned as
+    rrf_score; score stays the dense L2 distance either way.
+
+    filters restricts the results to matching chunks, e.g.
+    {"source": "clinicaltrials"}, {"nct_id": "NCT01234567"} or
+    {"query": "BPC-157"} (see metadata_index.FILTER_FIELDS). A value
+    can also be a list, any of which may match.
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {', '.join(RETRIEVAL_MODES)}")
+
+    with span("retrieve", queries=len(queries), k=k, mode=mode) as stage:
+        all_results = _retrieve_many(queries, k, mode, filters)
+        if stage.recording:
+            stage.set(chunk_ids=[[r["id"] for r in results] for results in all_results])
+
+    # Hand out copies so callers can't change what's cached
+    return [[dict(r) for r in results] for results in all_results]
+
+
+def _retrieve_many(queries, k, mode, filters):
+    resources = get_resources()
+    resources.reload_if_changed()
+    # Everything below reads this one build, even if a reload
+    # swaps in a newer one while we're searching
+    snapshot = resources.snapshot()
+    # Indexes built before BM25 was added only support dense search
+    if mode == "hybrid" and snapshot.bm25 is None:
+        mode = "dense"
+    filter_key = _filter_key(filters)
+    filters = {field: list(values) for field, values in filter_key}
+    allowed = None
+    if filters:
+        if snapshot.metadata_index is None:
+            raise ValueError("This index was built without a metadata index — re-run build_index.py to use filters")
+        allowed = snapshot.metadata_index.select(filters)
+    query_vectors = embed_queries(queries)
+
+    # Key on the embedding itself, so any two queries that
+    # normalise to the same text share one set of results. The build
+    # id keeps a request that finishes on the old build after a reload
+    # from caching its results for the new one.
+    cache = resources.retrieval_cache
+    cache_keys = [(vector.tobytes(), k, mode, filter_key, snapshot.build_id) for vector in query_vectors]
+    all_results = [cache.get(key) for key in cache_keys]
+
+    to_search = [i for i, results in enumerate(all_results) if results is None]
+    if to_search:
+        n_candidates = k * HYBRID_CANDIDATES if mode == "hybrid" else k
+        with span("faiss_search", queries=len(to_search), k=n_candidates, filtered=bool(filters)):
+            distances, indices = _dense_search(snapshot, query_vectors[to_search], n_candidates, filters, allowed)
+        for row, i in enumerate(to_search):
+            if mode == "hybrid":
+                # Postings lookups only — cheap next to the dense search
+                with span("bm25_search", k=n_candidates):
+                    _, lexical = snapshot.bm25.search(queries[i], n_candidates, allowed=allowed)
+                scores, ids = reciprocal_rank_fusion([indices[row], lexical], k)
+                dense = dict(zip(indices[row].tolist(), distances[row].tolist()))
+                all_results[i] = _format_results(snapshot.chunks, [dense.get(idx) for idx in ids], ids, scores)
+            else:
+                all_results[i] = _format_results(snapshot.chunks, distances[row], indices[row])
+            cache.put(cache_keys[i], all_results[i])
+
+    return all_results
+
+
+def retrieve(query, k=5, mode=DEFAULT_RETRIEVAL_MODE, filters=None):
+    """
+    Embeds the query and finds the k most relevant chunks.
+    Returns the chunks with their metadata.
+    """
+    return retrieve_many([query], k=k, mode=mode, filters=filters)[0]
+
+
+
+def build_prompt(question, retrieved_chunks, token_budget=None):
+    # Merge overlapping chunks, drop repeats and keep the research
+    # within token_budget tokens, which by default leaves room for
+    # every retrieved chunk (see context_packer.py)
+    with span("build_prompt", chunks_in=len(retrieved_chunks)) as stage:
+        packed = pack_context(retrieved_chunks, GENERATION_MODEL, token_budget=token_budget)
+        if stage.recording:
+            context_tokens = sum(chunk["tokens"] for chunk in packed)
+            stage.set(chunks_out=len(packed), context_tokens=context_tokens,
+                      chunk_ids=[chunk["id"] for chunk in packed if "id" in chunk])
 
-def build_prompt(question, retrieved_chunks):
     context_parts = []
-    for i, chunk in enumerate(retrieved_chunks):
+    for i, chunk in enumerate(packed):
         context_parts.append(f"[Source {i+1} - {chunk['source']}]\n{chunk['text']}")
     
     context = "\n\n---\n\n".join(context_parts)
@@ -69,43 +328,189 @@ USER QUESTION: {question}
 
 EDUCATIONAL ANSWER:"""
 
+    # Everything the model reads, instructions and question included
+    PROMPT_TOKENS.observe(count_tokens(prompt, GENERATION_MODEL))
     return prompt
 
 
 
 
-def generate_answer(prompt):
-    client = InferenceClient(token=HF_TOKEN)
-    
-    response = client.chat_completion(
-        model="mistralai/Mistral-7B-Instruct-v0.2",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=750,
-        temperature=0.3
-    )
-    
-    return response.choices[0].message.content
+_client = None
+
+
+def get_client():
+    """
+    One InferenceClient shared by every call, so HTTP connections
+    to the inference API are pooled instead of re-opened per answer.
+    """
+    global _client
+    if _client is None:
+        _client = InferenceClient(token=HF_TOKEN)
+    return _client
+
+
+def generate_answer(prompt, cache=None):
+    """
+    Sends the prompt to the generation model and returns the answer.
+    Pass an AnswerCache (see answer_cache.py) to reuse answers for
+    prompts we've already sent.
+    """
+    with span("generate", prompt_chars=len(prompt)) as stage:
+        if cache is not None:
+            cached = cache.get(GENERATION_MODEL, prompt, GENERATION_PARAMS)
+            if cached is not None:
+                stage.set(cached=True)
+                return cached
+
+        client = get_client()
+
+        response = client.chat_completion(
+            model=GENERATION_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            **GENERATION_PARAMS
+        )
+
+        answer = response.choices[0].message.content
+        stage.set(cached=False, answer_chars=len(answer))
+        if cache is not None:
+            cache.put(GENERATION_MODEL, prompt, GENERATION_PARAMS, answer)
+        return answer
+
+
+def generate_answer_stream(prompt, cache=None):
+    """
+    Same as generate_answer, but yields the answer piece by piece
+    as the model produces it, so the UI can start showing text
+    straight away instead of waiting for all 750 tokens.
+    A cache hit is yielded as one piece.
+    """
+    with span("generate", prompt_chars=len(prompt), stream=True) as stage:
+        if cache is not None:
+            cached = cache.get(GENERATION_MODEL, prompt, GENERATION_PARAMS)
+            if cached is not None:
+                stage.set(cached=True)
+                yield cached
+                return
+
+        client = get_client()
+        start = time.perf_counter()
+
+        stream = client.chat_completion(
+            model=GENERATION_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            **GENERATION_PARAMS
+        )
+
+        pieces = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                if not pieces and stage.recording:
+                    stage.set(first_token_ms=round((time.perf_counter() - start) * 1000, 2))
+                pieces.append(token)
+                yield token
+
+        stage.set(cached=False, answer_chars=sum(len(piece) for piece in pieces))
+        # Only cache answers that streamed all the way to the end
+        if cache is not None:
+            cache.put(GENERATION_MODEL, prompt, GENERATION_PARAMS, "".join(pieces))
 
 
-def ask(question, k=5):
+def make_async_client():
+    """
+    Creates an AsyncInferenceClient for concurrent generation.
+    Create one per run and reuse it for every request.
+    """
+    return AsyncInferenceClient(token=HF_TOKEN)
+
+
+async def generate_answer_async(prompt, client, cache=None):
+    """
+    Async version of generate_answer, for running many
+    generations concurrently on one shared client.
+    """
+    with span("generate", prompt_chars=len(prompt)) as stage:
+        if cache is not None:
+            cached = cache.get(GENERATION_MODEL, prompt, GENERATION_PARAMS)
+            if cached is not None:
+                stage.set(cached=True)
+                return cached
+
+        response = await client.chat_completion(
+            model=GENERATION_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            **GENERATION_PARAMS
+        )
+        answer = response.choices[0].message.content
+        stage.set(cached=False, answer_chars=len(answer))
+        if cache is not None:
+            cache.put(GENERATION_MODEL, prompt, GENERATION_PARAMS, answer)
+    return answer
+
+
+def index_build_id():
+    """
+    Id of the index build queries are currently served from,
+    picking up a rebuild on disk first.
+    """
+    resources = get_resources()
+    resources.reload_if_changed()
+    return resources.snapshot().build_id
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache(dataset_path="data/dataset.json"):
+    """
+    Returns the shared semantic answer cache, seeded on first use
+    with the question/answer pairs from the generated dataset. It
+    empties and re-seeds itself when the index is rebuilt.
+    """
+    global _semantic_cache
+    if _semantic_cache is None:
+        with _semantic_cache_lock:
+            if _semantic_cache is None:
+                semantic_cache = SemanticCache(embed_queries, build_id=index_build_id)
+                seeded = semantic_cache.seed_from_dataset(dataset_path, retrieve_many=retrieve_many)
+                print(f"Semantic cache seeded with {len(semantic_cache)} answers from {seeded} dataset pairs")
+                _semantic_cache = semantic_cache
+    return _semantic_cache
+
+
+def ask(question, k=5, cache=None, semantic_cache=None):
     """
     Full RAG pipeline — retrieves relevant chunks,
     builds a prompt, and generates a real answer.
+    Pass a SemanticCache to answer near-duplicates of questions
+    we've already answered without retrieving or generating.
     """
     print(f"\nQuestion: {question}")
-    print("Retrieving relevant research...")
-    
-    retrieved = retrieve(question, k=k)
-    prompt = build_prompt(question, retrieved)
-    
-    print("Generating answer...")
-    answer = generate_answer(prompt)
-    
+
+    hit = semantic_cache.lookup(question) if semantic_cache is not None else None
+    if hit is not None:
+        print(f"Answered from a similar question ({hit['similarity']}): {hit['question']}")
+        answer, retrieved = hit["answer"], hit["sources"]
+    else:
+        print("Retrieving relevant research...")
+
+        retrieved = retrieve(question, k=k)
+        prompt = build_prompt(question, retrieved)
+
+        print("Generating answer...")
+        answer = generate_answer(prompt, cache=cache)
+        if semantic_cache is not None:
+            semantic_cache.add(question, answer, retrieved)
+
     print("\n--- ANSWER ---")
     print(answer)
     print("\n--- SOURCES ---")
     for i, r in enumerate(retrieved):
-        print(f"  {i+1}. [{r['source']}] score: {r['score']}")
+        print(f"  {i+1}. [{r['source']}] {score_label(r)}")
     
     return answer, retrieved
 
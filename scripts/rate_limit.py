@@ -0,0 +1,153 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from http_cache import get_cache
+
+
+class TokenBucket:
+    """
+    A simple asyncio token-bucket rate limiter.
+
+    The bucket holds up to `capacity` tokens and refills at `rate`
+    tokens per second. Every request takes one token, so no matter
+    how many coroutines are running at once we never go over the
+    rate the remote API allows (e.g. NCBI's 3 requests/second).
+
+    capacity defaults to 1, so requests are spaced 1/rate apart and no
+    one-second window ever holds more than `rate` of them. A bigger
+    capacity allows bursts on top of the rate, which APIs that count
+    per second (like NCBI) reject.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # The lock makes waiters queue up in order, so one slow
+        # coroutine can't be starved by the others
+        async with self.lock:
+            self._refill()
+            # A loop, since sleep() can wake a hair early
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+async def fetch_with_retry(url, params, limiter, method="GET", timeout=30, retries=4, label=None):
+    """
+    Sends one HTTP request through the rate limiter and returns the
+    response. Retries with exponential backoff on timeouts, 429s and
+    5xx errors, which public APIs like NCBI hand out under load.
+    Other 4xx errors are raised straight away since retrying won't help.
+    Use method="POST" for long parameter lists that won't fit in a URL.
+
+    Responses go through the shared HTTP cache; cache hits return
+    straight away without using up any of the rate limit.
+    """
+    label = label or url
+    cache = get_cache()
+
+    cached = cache.lookup(method, url, params)
+    if cached is not None:
+        return cached
+
+    for attempt in range(retries + 1):
+        await limiter.acquire()
+        try:
+            # requests is blocking, so run it in a worker thread
+            # and let the event loop keep the other requests moving
+            response = await asyncio.to_thread(cache.fetch, method, url, params, timeout)
+            transient = response.status_code == 429 or response.status_code >= 500
+            if not transient:
+                response.raise_for_status()
+                return response
+            error = f"HTTP {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = str(e)
+
+        if attempt == retries:
+            raise requests.HTTPError(f"{label} failed after {retries + 1} attempts: {error}")
+        wait = 2 ** attempt
+        print(f"  Retrying {label} in {wait}s ({error})")
+        await asyncio.sleep(wait)
+
+
+def retry_after_seconds(headers):
+    """
+    Parses a Retry-After header, which can be either a number of
+    seconds or an HTTP date. Returns None if there isn't a usable one.
+    """
+    value = (headers or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class AdaptiveConcurrency:
+    """
+    Limits how many requests are in flight, and adapts that limit
+    to how the server is coping (additive increase, multiplicative
+    decrease — the same idea TCP uses).
+
+    Every success nudges the limit back up towards `max_limit`. A 429
+    or 5xx halves it and pauses everyone until the backoff (or the
+    server's Retry-After) has passed, so a struggling endpoint gets
+    breathing room instead of a pile of immediate retries.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                try:
+                    # Wake up when a slot frees or the pause ends
+                    await asyncio.wait_for(self.condition.wait(), timeout=wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, throttled=False, backoff=None):
+        """
+        Frees a slot. Pass throttled=True when the server pushed back
+        (429/5xx), optionally with how long to back off for.
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            if not throttled:
+                self.limit = min(self.max_limit, self.limit + 1 / max(self.limit, 1))
+            else:
+                self.limit = max(self.min_limit, self.limit / 2)
+                if backoff:
+                    self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+            self.condition.notify_all()
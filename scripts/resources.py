@@ -0,0 +1,276 @@
+import os
+import threading
+import time
+
+import faiss
+
+from bm25_index import BM25_INDEX_PATH, load_bm25_index
+from chunk_store import CHUNK_STORE_PATH, CHUNKS_JSON_PATH, open_chunks
+from encoders import make_encoder
+from index_io import (INDEX_MANIFEST_PATH, INDEX_META_PATH, INDEX_PATH, apply_search_params, load_index,
+                      load_manifest, manifest_matches)
+from metadata_index import METADATA_INDEX_PATH, load_metadata_index
+from query_cache import LRUCache
+
+# The embedding model used for queries. It has to match the
+# model build_index used to embed the chunks.
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+# build_index swaps its files in within a few milliseconds, so if we
+# catch it mid-swap while loading, a short wait is enough to retry
+LOAD_ATTEMPTS = 5
+LOAD_RETRY_SECONDS = 0.2
+
+
+class IndexSnapshot:
+    """
+    One build's index, metadata, chunk store, BM25 and metadata
+    indexes, loaded together. A request takes one snapshot and uses
+    only that, so FAISS ids are always looked up in the chunk store of
+    the same build even if a reload swaps in a newer one meanwhile.
+
+    The old chunk store is closed when the last snapshot holding it
+    goes away, not when a reload happens, so requests still reading it
+    aren't cut off.
+    """
+
+    def __init__(self, signature, manifest, index, index_meta, chunks, bm25, metadata_index):
+        self.signature = signature
+        self.manifest = manifest
+        self.index = index
+        self.index_meta = index_meta
+        self.chunks = chunks
+        self.bm25 = bm25
+        self.metadata_index = metadata_index
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def build_id(self):
+        """
+        Identifies the build this snapshot was loaded from, for keying
+        caches whose entries are only valid for one build.
+        """
+        if self.manifest is not None:
+            return self.manifest["generation"]
+        return self.signature
+
+    def partition(self, source):
+        """
+        The sub-index holding only one source's chunks, loaded on first
+        use. Returns None if build_index didn't write one for it.
+        """
+        info = self.index_meta.get("partitions", {}).get(source)
+        if info is None:
+            return None
+        if source not in self._partitions:
+            with self._lock:
+                if source not in self._partitions:
+                    if self.manifest is not None and not manifest_matches(self.manifest, [info["path"]]):
+                        # A rebuild has replaced it since this snapshot
+                        # was loaded; search the main index instead
+                        return None
+                    partition = faiss.read_index(info["path"])
+                    apply_search_params(partition, info.get("search_params"))
+                    self._partitions[source] = partition
+        return self._partitions[source]
+
+
+class RagResources:
+    """
+    Owns everything the RAG pipeline needs at query time: the
+    embedding model, the current IndexSnapshot and the retrieval
+    caches.
+
+    Nothing is loaded until it's first used, so importing the
+    pipeline (e.g. just for build_prompt) costs nothing. Loading is
+    guarded by a lock, so concurrent Streamlit sessions or worker
+    threads share one copy instead of racing to load their own.
+    """
+
+    def __init__(self, model_name=MODEL_NAME, index_path=INDEX_PATH, meta_path=INDEX_META_PATH,
+                 chunk_store_path=CHUNK_STORE_PATH, chunks_json_path=CHUNKS_JSON_PATH,
+                 bm25_path=BM25_INDEX_PATH, metadata_index_path=METADATA_INDEX_PATH,
+                 manifest_path=INDEX_MANIFEST_PATH):
+        self.model_name = model_name
+        self.index_path = index_path
+        self.meta_path = meta_path
+        self.chunk_store_path = chunk_store_path
+        self.chunks_json_path = chunks_json_path
+        self.bm25_path = bm25_path
+        self.metadata_index_path = metadata_index_path
+        self.manifest_path = manifest_path
+
+        self._lock = threading.RLock()
+        self._model = None
+        self._snapshot = None
+
+        # Repeat questions are common (the app, retry_failed...), so cache
+        # both the query embedding and the search results. Results expire
+        # after an hour and both caches are dropped when the index changes.
+        self.query_embedding_cache = LRUCache(maxsize=4096)
+        self.retrieval_cache = LRUCache(maxsize=4096, ttl=3600)
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    # torch, int8 or onnx, picked with ENCODER_BACKEND
+                    # (see encoders.py). Only the torch backends pull in
+                    # torch, which is most of the cost of loading the pipeline.
+                    self._model = make_encoder(self.model_name)
+        return self._model
+
+    def snapshot(self):
+        """
+        The index files currently in use, loading them on first use.
+        Take this once per request and read everything through it.
+        """
+        if self._snapshot is None:
+            self._load_index()
+        return self._snapshot
+
+    # Shortcuts to the current snapshot. Each one may come from a
+    # different build if a reload happens in between, so anything
+    # that uses more than one of them should take a snapshot() instead.
+    @property
+    def index(self):
+        return self.snapshot().index
+
+    @property
+    def index_meta(self):
+        return self.snapshot().index_meta
+
+    @property
+    def chunks(self):
+        return self.snapshot().chunks
+
+    @property
+    def bm25(self):
+        """The BM25 keyword index, or None for indexes built without one."""
+        return self.snapshot().bm25
+
+    @property
+    def metadata_index(self):
+        """The filter lookup index, or None for indexes built without one."""
+        return self.snapshot().metadata_index
+
+    def partition(self, source):
+        return self.snapshot().partition(source)
+
+    def _file_signature(self):
+        """
+        Modification time and size of the manifest build_index writes
+        once a rebuild is complete. Indexes built before the manifest
+        existed fall back to the index, chunk store and BM25 files.
+        """
+        paths = [self.manifest_path]
+        if not os.path.exists(self.manifest_path):
+            paths = [self.index_path, self.chunk_store_path, self.bm25_path]
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _read_snapshot(self):
+        """
+        Reads the index, chunk store, BM25 and metadata indexes. Returns
+        them as a snapshot, or None if build_index swapped in new files
+        while we were reading, in which case what we read may mix two builds.
+        """
+        signature = self._file_signature()
+        manifest = load_manifest(self.manifest_path)
+        # load_index applies the nprobe/efSearch defaults build_index saved
+        index, index_meta = load_index(self.index_path, self.meta_path)
+        # Memory-mapped chunk store — chunks are only decoded when retrieved
+        chunks = open_chunks(self.chunk_store_path, self.chunks_json_path)
+        bm25 = load_bm25_index(self.bm25_path)
+        metadata_index = load_metadata_index(self.metadata_index_path)
+
+        if manifest is not None and not (manifest_matches(manifest) and self._file_signature() == signature):
+            return None
+        return IndexSnapshot(signature, manifest, index, index_meta, chunks, bm25, metadata_index)
+
+    def _load_index(self):
+        with self._lock:
+            if self._snapshot is not None:
+                return
+            for _ in range(LOAD_ATTEMPTS):
+                snapshot = self._read_snapshot()
+                if snapshot is not None:
+                    self._snapshot = snapshot
+                    return
+                time.sleep(LOAD_RETRY_SECONDS)
+            raise RuntimeError("The index files kept changing while loading them — is build_index still running?")
+
+    def reload_if_changed(self):
+        """
+        Swaps in a new snapshot and clears the caches when the files on
+        disk have changed since we loaded them. It's one stat() of the
+        manifest, so it's cheap enough to do on every query. Requests
+        already holding the old snapshot finish with it.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or self._file_signature() == snapshot.signature:
+            return
+        with self._lock:
+            if self._file_signature() == self._snapshot.signature:
+                return
+            snapshot = self._read_snapshot()
+            if snapshot is None:
+                # build_index is swapping files in right now. Keep
+                # serving the old ones and try again on the next query.
+                return
+            self._snapshot = snapshot
+            self.query_embedding_cache.clear()
+            self.retrieval_cache.clear()
+            print("Index changed on disk — reloaded and cleared retrieval caches")
+
+    def warm_up(self):
+        """
+        Loads the model, index and chunks now rather than on the first
+        question, and runs one encode so the first real query doesn't
+        pay for model initialisation either.
+        """
+        self.model.encode(["warm up"])
+        self.snapshot()
+        print(f"RAG pipeline loaded successfully ({self.model.backend} encoder)")
+        return self
+
+    def cache_stats(self):
+        """
+        Hit rates for the query embedding and retrieval caches.
+        """
+        return {
+            "query_embeddings": self.query_embedding_cache.stats(),
+            "retrieval": self.retrieval_cache.stats()
+        }
+
+
+_resources = None
+_resources_lock = threading.Lock()
+
+
+def get_resources():
+    """
+    Returns the process-wide RagResources, creating it on first use.
+    """
+    global _resources
+    if _resources is None:
+        with _resources_lock:
+            if _resources is None:
+                _resources = RagResources()
+    return _resources
+
+
+def warm_up():
+    """
+    Loads everything up front. Call this at start-up in long-running
+    processes (like the app) so no user waits on the first query.
+    """
+    return get_resources().warm_up()
@@ -1,14 +1,32 @@
-import json
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
+# Uses the same model, index and chunk store as the RAG pipeline,
+# so what we eyeball here is exactly what the app retrieves
+from rag_pipeline import retrieve_many, score_label
 
-# Load everything we built
-model = SentenceTransformer("all-MiniLM-L6-v2")
-index = faiss.read_index("data/faiss_index.bin")
 
-with open("data/chunks_indexed.json") as f:
-    chunks = json.load(f)
+def _format(results):
+    formatted = []
+    for i, r in enumerate(results):
+        result = {
+            "rank": i + 1,
+            "score": r["score"],
+            "source": r["source"],
+            "text": r["text"][:400]  # first 400 chars
+        }
+        # Only hybrid results have one
+        if "rrf_score" in r:
+            result["rrf_score"] = r["rrf_score"]
+        formatted.append(result)
+    return formatted
+
+
+def retrieve_all(questions, k=3):
+    """
+    Takes a list of plain English questions, embeds them in one
+    batch, searches FAISS once for the k most similar chunks per
+    question, and returns one result list per question.
+    """
+    return [_format(results) for results in retrieve_many(questions, k=k)]
+
 
 def retrieve(query, k=3):
     """
@@ -16,27 +34,11 @@ def retrieve(query, k=3):
     searches FAISS for the k most similar chunks,
     and returns them.
     """
-    # Embed the query the same way we embedded the chunks
-    query_vector = model.encode([query])
-    query_vector = np.array(query_vector).astype("float32")
-
-    # Search the index — returns distances and indices
-    distances, indices = index.search(query_vector, k)
-
-    results = []
-    for i, idx in enumerate(indices[0]):
-        chunk = chunks[idx]
-        results.append({
-            "rank": i + 1,
-            "score": round(float(distances[0][i]), 4),
-            "source": chunk["source"],
-            "text": chunk["text"][:400]  # first 400 chars
-        })
-
-    return results
+    return retrieve_all([query], k=k)[0]
 
 
-# Test it with some sample questions
+# Test it with some sample questions. This is for eyeballing results;
+# benchmark_retrieval.py measures recall and latency properly.
 test_questions = [
     #"What are the side effects of taking reta?"   
     #"What is the mechanism of action of retatrutide?",
@@ -45,11 +47,10 @@ test_questions = [
     #"How does glutathione affect weight loss?"
 ]
 
-for question in test_questions:
+for question, results in zip(test_questions, retrieve_all(test_questions, k=3)):
     print(f"\n{'='*60}")
     print(f"QUESTION: {question}")
     print(f"{'='*60}")
-    results = retrieve(question, k=3)
     for r in results:
-        print(f"\nRank {r['rank']} | Source: {r['source']} | Score: {r['score']}")
-        print(f"{r['text']}...")
\ No newline at end of file
+        print(f"\nRank {r['rank']} | Source: {r['source']} | {score_label(r)}")
+        print(f"{r['text']}...")
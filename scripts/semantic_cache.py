@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+
+import faiss
+import numpy as np
+
+# Cosine similarity a new question needs with a stored one to reuse
+# its answer. High enough that "side effects of reta" matches "What
+# are the side effects of taking reta?" but "Is BPC-157 safe?" doesn't
+# match "Is TB-500 safe?". Override with SEMANTIC_CACHE_THRESHOLD.
+DEFAULT_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.88"))
+
+# Stop adding new questions past this many entries
+DEFAULT_MAX_ENTRIES = 50_000
+
+
+class SemanticCache:
+    """
+    Answers near-duplicate questions from previously answered ones.
+
+    Question embeddings go into a small exact inner-product FAISS
+    index (cosine similarity, since vectors are normalised). A lookup
+    is one query embedding plus one search over at most a few
+    thousand vectors, so a hit skips both retrieval and generation.
+
+    `embed` is a function that turns a list of strings into an (n, dim)
+    float32 array — rag_pipeline.embed_queries, so lookups share its
+    query embedding cache.
+
+    `build_id`, if given, is a function returning the id of the index
+    build in use. Stored answers and sources only hold for the build
+    they were retrieved from, so when it changes the cache is emptied
+    and re-seeded from the dataset it was seeded from.
+    """
+
+    def __init__(self, embed, threshold=DEFAULT_THRESHOLD, max_entries=DEFAULT_MAX_ENTRIES, build_id=None):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.build_id = build_id
+        self.index = None
+        self.entries = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._build = None
+        self._seed = None
+        self._build_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _check_build(self):
+        """
+        Empties and re-seeds the cache if the index has been rebuilt
+        since its entries were stored.
+        """
+        if self.build_id is None:
+            return
+        current = self.build_id()
+        if current == self._build:
+            return
+        with self._build_lock:
+            if current == self._build:
+                return
+            with self.lock:
+                self.index = None
+                self.entries = []
+            rebuilt = self._build is not None
+            self._build = current
+            if rebuilt:
+                print("Index changed — cleared the semantic cache")
+                if self._seed is not None:
+                    self.seed_from_dataset(*self._seed)
+
+    def _normalised(self, questions):
+        vectors = np.array(self.embed(questions), dtype="float32")
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def lookup(self, question):
+        """
+        Returns the closest stored entry ({"question", "answer",
+        "sources", "similarity"}) if it clears the threshold, else None.
+        """
+        self._check_build()
+        if not self.entries:
+            self.misses += 1
+            return None
+
+        vector = self._normalised([question])
+        with self.lock:
+            similarities, ids = self.index.search(vector, 1)
+            best = int(ids[0][0])
+            similarity = float(similarities[0][0])
+            if best < 0 or similarity < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(self.entries[best], similarity=round(similarity, 4))
+
+    def add_many(self, questions, answers, sources_list):
+        """
+        Stores answered questions. Questions that are practically
+        identical to one already stored are skipped.
+        """
+        self._check_build()
+        if not questions:
+            return
+        vectors = self._normalised(questions)
+
+        with self.lock:
+            if self.index is None:
+                self.index = faiss.IndexFlatIP(vectors.shape[1])
+
+            for vector, question, answer, sources in zip(vectors, questions, answers, sources_list):
+                if len(self.entries) >= self.max_entries:
+                    break
+                if self.entries:
+                    similarity, _ = self.index.search(vector.reshape(1, -1), 1)
+                    if similarity[0][0] >= 0.99:
+                        continue
+                self.index.add(vector.reshape(1, -1))
+                self.entries.append({"question": question, "answer": answer, "sources": sources})
+
+    def add(self, question, answer, sources):
+        self.add_many([question], [answer], [sources])
+
+    def seed_from_dataset(self, dataset_path="data/dataset.json", retrieve_many=None, k=5):
+        """
+        Pre-fills the cache with the generated question/answer pairs.
+        The dataset doesn't store sources, so if `retrieve_many` is
+        given they're re-retrieved for every question in one batch.
+        """
+        self._check_build()
+        self._seed = (dataset_path, retrieve_many, k)
+        if not os.path.exists(dataset_path):
+            return 0
+        with open(dataset_path) as f:
+            pairs = json.load(f)
+
+        questions = [pair["instruction"] for pair in pairs]
+        answers = [pair["response"] for pair in pairs]
+        sources = retrieve_many(questions, k=k) if retrieve_many else [[] for _ in pairs]
+        self.add_many(questions, answers, sources)
+        return len(pairs)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
@@ -0,0 +1,255 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Tracing is off unless RAG_TRACING=1. When it's off, span() hands back
+# a bare timer that only feeds the stage histogram — no attributes, no
+# trace — so instrumented code pays for two clock reads and one
+# histogram update. The metrics are always recorded.
+ENABLED = os.getenv("RAG_TRACING", "0") == "1"
+
+# Finished traces are appended here as JSON lines (set to "" to skip),
+# and the histograms are rewritten here in Prometheus text format after
+# every trace, for a node_exporter textfile collector to pick up.
+# Without traces they're rewritten at most every METRICS_INTERVAL seconds.
+TRACE_LOG_PATH = os.getenv("RAG_TRACE_LOG", "data/traces.jsonl")
+METRICS_PATH = os.getenv("RAG_METRICS_PATH", "data/metrics.prom")
+METRICS_INTERVAL = 15
+
+# Seconds; covers everything from a FAISS search to a slow LLM call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def enable(flag=True):
+    global ENABLED
+    ENABLED = flag
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram: cumulative bucket counts, a sum and
+    a count, kept separately for every combination of labels.
+    """
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def prometheus_lines(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                labels = ",".join(f'{name}="{value}"' for name, value in key)
+                prefix = labels + "," if labels else ""
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series["count"]}')
+                lines.append(f"{self.name}_sum{{{labels}}} {series['sum']:.6f}")
+                lines.append(f"{self.name}_count{{{labels}}} {series['count']}")
+        return lines
+
+
+REGISTRY = []
+STAGE_SECONDS = Histogram("rag_stage_seconds", "Time spent in each RAG pipeline stage", LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram("rag_prompt_tokens", "Tokens in each prompt sent to the generation model", TOKEN_BUCKETS)
+
+
+def prometheus_text():
+    """All histograms in the Prometheus text exposition format."""
+    return "\n".join(line for histogram in REGISTRY for line in histogram.prometheus_lines()) + "\n"
+
+
+_write_lock = threading.Lock()
+
+
+def write_metrics(path=METRICS_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    # Requests finishing together would otherwise share the tmp file
+    with _write_lock:
+        with open(tmp_path, "w") as f:
+            f.write(prometheus_text())
+        os.replace(tmp_path, path)
+
+
+_last_export = 0.0
+
+
+def _export_metrics_if_due():
+    """
+    Rewrites the metrics file if it's been METRICS_INTERVAL seconds
+    since the last write, for processes that aren't tracing.
+    """
+    global _last_export
+    now = time.monotonic()
+    if not METRICS_PATH or now - _last_export < METRICS_INTERVAL:
+        return
+    _last_export = now
+    try:
+        write_metrics(METRICS_PATH)
+    except OSError as e:
+        print(f"Couldn't export metrics: {e}")
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# The last few traces, for the app's debug panel
+recent_traces = deque(maxlen=50)
+
+
+class Span:
+    """
+    Times one stage. Attributes added with set() end up in the trace.
+    """
+
+    recording = True
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.trace = _current_trace.get()
+        self.depth = 0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        if self.trace is not None:
+            self.depth = self.trace.depth
+            self.trace.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        STAGE_SECONDS.observe(self.duration, stage=self.name)
+        if self.trace is None:
+            _export_metrics_if_due()
+        else:
+            self.trace.depth -= 1
+            self.trace.spans.append({
+                "name": self.name,
+                "depth": self.depth,
+                "offset_ms": round((self.start - self.trace.start) * 1000, 2),
+                "duration_ms": round(self.duration * 1000, 2),
+                **self.attrs
+            })
+        return False
+
+
+class _TimingSpan:
+    """
+    What span() and trace() return when tracing is off: times the
+    block for the stage histogram and ignores everything else.
+    """
+
+    recording = False
+
+    def __init__(self, name):
+        self.name = name
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, stage=self.name)
+        _export_metrics_if_due()
+        return False
+
+
+def span(name, **attrs):
+    """
+    Times the block it wraps:
+
+        with span("faiss_search", k=k) as s:
+            ...
+            s.set(results=len(ids))
+
+    Check s.recording before working out attributes that cost anything.
+    """
+    if not ENABLED:
+        return _TimingSpan(name)
+    return Span(name, attrs)
+
+
+class Trace:
+    """
+    Collects the spans of one request (one question in the app).
+    """
+
+    recording = True
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.depth = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_trace.reset(self.token)
+        self.duration = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(self.duration, stage=self.name)
+        recent_traces.append(self.to_dict())
+        try:
+            if TRACE_LOG_PATH:
+                os.makedirs(os.path.dirname(TRACE_LOG_PATH) or ".", exist_ok=True)
+                with open(TRACE_LOG_PATH, "a") as f:
+                    f.write(json.dumps(self.to_dict()) + "\n")
+            if METRICS_PATH:
+                write_metrics(METRICS_PATH)
+        except OSError as e:
+            # Never fail a request because its trace couldn't be written
+            print(f"Couldn't export trace: {e}")
+        return False
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 2) if hasattr(self, "duration") else None,
+            **self.attrs,
+            "spans": sorted(self.spans, key=lambda s: s["offset_ms"])
+        }
+
+
+def trace(name, **attrs):
+    """
+    Groups every span inside the block into one trace, which is
+    exported when the block ends. When tracing is off it only times
+    the block, like span().
+    """
+    if not ENABLED:
+        return _TimingSpan(name)
+    return Trace(name, attrs)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts import each other as top-level modules, the same way
+# app.py does, so put scripts/ on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
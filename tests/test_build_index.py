@@ -0,0 +1,33 @@
+import faiss
+import numpy as np
+import pytest
+
+from build_index import build_partitions, make_index
+
+
+def _corpus(sizes, dimension=16, seed=0):
+    rng = np.random.default_rng(seed)
+    chunks = [{"text": f"{source} {i}", "source": source} for source, n in sizes.items() for i in range(n)]
+    embeddings = rng.random((len(chunks), dimension)).astype("float32")
+    return chunks, embeddings
+
+
+def test_explicit_nlist_is_capped_to_the_training_set():
+    index, factory, search_params, _ = make_index("ivf_flat:nlist=1200", 16, 1000)
+    assert factory == "IVF25,Flat"
+    assert search_params["nprobe"] <= 25
+
+
+@pytest.mark.parametrize("spec", ["ivf_flat:nlist=1200", "ivf_pq:nlist=1024"])
+def test_undersized_partition_still_builds(spec, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    chunks, embeddings = _corpus({"pubmed": 3000, "clinicaltrials": 200})
+
+    partitions = build_partitions(chunks, embeddings, spec)
+
+    assert {source: p["ntotal"] for source, p in partitions.items()} == {"pubmed": 3000, "clinicaltrials": 200}
+    small = faiss.read_index(str(tmp_path / (partitions["clinicaltrials"]["path"] + ".new")))
+    _, ids = small.search(embeddings[3000:3005], 1)
+    # Partition ids map back to rows in the main index
+    assert set(ids.ravel()) <= set(range(3000, 3200))
@@ -0,0 +1,35 @@
+import random
+
+import pytest
+
+import context_packer
+from context_packer import pack_context
+
+MODEL = "test-model"
+
+
+class DenseTokenizer:
+    """Splits more finely than CHARS_PER_TOKEN assumes, like a real tokenizer on drug names and doses."""
+
+    def encode(self, text, add_special_tokens=False):
+        return list(range(int(len(text) / 2.8)))
+
+
+def _chunk(i, words):
+    text = ""
+    while len(text) < 1500:
+        text += random.choice(words) + " "
+    return {"id": i, "text": text[:1500], "source": "pubmed", "pmid": str(10_000 + i)}
+
+
+@pytest.mark.parametrize("tokenizer", [None, DenseTokenizer()], ids=["estimated", "dense"])
+def test_five_full_size_chunks_all_survive(monkeypatch, tokenizer):
+    monkeypatch.setattr(context_packer, "FIXED_TOKEN_BUDGET", None)
+    monkeypatch.setitem(context_packer._tokenizers, MODEL, tokenizer)
+    random.seed(0)
+    words = [f"word{n}" for n in range(2000)]
+    chunks = [_chunk(i, words) for i in range(5)]
+
+    packed = pack_context(chunks, MODEL)
+
+    assert [chunk["id"] for chunk in packed] == [0, 1, 2, 3, 4]
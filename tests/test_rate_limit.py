@@ -0,0 +1,36 @@
+import asyncio
+import time
+
+from rate_limit import TokenBucket
+
+
+def _send_times(rate, n, concurrency):
+    async def run():
+        limiter = TokenBucket(rate)
+        sent = []
+
+        async def worker(count):
+            for _ in range(count):
+                await limiter.acquire()
+                sent.append(time.monotonic())
+
+        await asyncio.gather(*(worker(n // concurrency) for _ in range(concurrency)))
+        return sorted(sent)
+
+    return asyncio.run(run())
+
+
+def test_no_one_second_window_exceeds_the_rate():
+    rate = 10
+    sent = _send_times(rate, 30, concurrency=5)
+
+    assert len(sent) == 30
+    for start in sent:
+        in_window = sum(start <= t < start + 1.0 - 1e-9 for t in sent)
+        assert in_window <= rate
+
+
+def test_first_second_is_not_a_burst():
+    sent = _send_times(3, 6, concurrency=6)
+    first_second = [t - sent[0] for t in sent if t - sent[0] < 1.0 - 1e-9]
+    assert len(first_second) <= 3